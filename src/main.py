@@ -3,9 +3,13 @@ import sys
 # DON'T CHANGE THIS !!!
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
+import click
 from flask import Flask, send_from_directory
 from flask_cors import CORS
-from src.models.user import db
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import configure_mappers
+from src.models.user import db, create_missing_indexes, missing_unique_indexes
+from src.utils import fastjson
 from src.routes.user import user_bp
 from src.routes.auth import auth_bp
 from src.routes.story import story_bp
@@ -13,50 +17,98 @@ from src.routes.illustration import illustration_bp
 from src.routes.payment import payment_bp
 from src.routes.admin import admin_bp
 
-app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
-app.config['SECRET_KEY'] = 'zingybooks_secret_key_2024'
-
-# Enable CORS for all routes
-CORS(app, origins=['*'])
-
-# Register blueprints
-app.register_blueprint(user_bp, url_prefix='/api')
-app.register_blueprint(auth_bp, url_prefix='/api')
-app.register_blueprint(story_bp, url_prefix='/api')
-app.register_blueprint(illustration_bp, url_prefix='/api')
-app.register_blueprint(payment_bp, url_prefix='/api')
-app.register_blueprint(admin_bp, url_prefix='/api')
-
-# Database configuration
-app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{os.path.join(os.path.dirname(__file__), 'database', 'app.db')}"
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-db.init_app(app)
-
-# Create database tables
-with app.app_context():
-    db.create_all()
-
-@app.route('/', defaults={'path': ''})
-@app.route('/<path:path>')
-def serve(path):
-    static_folder_path = app.static_folder
-    if static_folder_path is None:
-        return "Static folder not configured", 404
-
-    if path != "" and os.path.exists(os.path.join(static_folder_path, path)):
-        return send_from_directory(static_folder_path, path)
-    else:
-        index_path = os.path.join(static_folder_path, 'index.html')
-        if os.path.exists(index_path):
-            return send_from_directory(static_folder_path, 'index.html')
+def create_app():
+    """Build the ZingyBooks Flask application"""
+    app = Flask(__name__, static_folder=os.path.join(os.path.dirname(__file__), 'static'))
+    app.config['SECRET_KEY'] = 'zingybooks_secret_key_2024'
+    app.json = fastjson.ORJSONProvider(app)
+
+    # Enable CORS for all routes
+    CORS(app, origins=['*'])
+
+    # Register blueprints
+    app.register_blueprint(user_bp, url_prefix='/api')
+    app.register_blueprint(auth_bp, url_prefix='/api')
+    app.register_blueprint(story_bp, url_prefix='/api')
+    app.register_blueprint(illustration_bp, url_prefix='/api')
+    app.register_blueprint(payment_bp, url_prefix='/api')
+    app.register_blueprint(admin_bp, url_prefix='/api')
+
+    # Database configuration
+    # DATABASE_URL points the app at another database, e.g. a scratch one for the tests
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+        'DATABASE_URL', f"sqlite:///{os.path.join(os.path.dirname(__file__), 'database', 'app.db')}"
+    )
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    engine_options = {
+        'pool_pre_ping': True,
+        'pool_recycle': 1800,
+        # Room for every compiled statement the routes issue
+        'query_cache_size': 1200,
+        # JSON columns are (de)serialized with orjson as well
+        'json_serializer': fastjson.dumps,
+        'json_deserializer': fastjson.loads
+    }
+    # Pool sized for concurrent API/admin traffic; LIFO keeps warm connections in use
+    # SQLite may get a StaticPool (in-memory URLs), which rejects these sizing options
+    if make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name() != 'sqlite':
+        engine_options.update(pool_size=20, max_overflow=10, pool_use_lifo=True)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
+    db.init_app(app)
+
+    # Create database tables
+    with app.app_context():
+        db.create_all()
+        # create_all() leaves existing tables alone; indexes added later come from `flask create-indexes`
+        missing_indexes = missing_unique_indexes()
+
+    # Routes rely on these for correctness (e.g. one order per Razorpay ID), so serve nothing without them
+    if missing_indexes:
+        app.logger.error('Missing unique indexes %s; run `flask --app src.main create-indexes`',
+                         ', '.join(missing_indexes))
+
+        @app.before_request
+        def refuse_without_unique_indexes():
+            return {'error': 'Database schema is out of date'}, 503
+
+    @app.cli.command('create-indexes')
+    def create_indexes_command():
+        """Create model indexes missing from tables that already exist"""
+        failed = create_missing_indexes()
+        for index_name, error in failed:
+            click.echo(f'Could not create index {index_name}: {error}', err=True)
+        if failed:
+            raise SystemExit(1)
+        click.echo('Indexes are up to date')
+
+    # Set up backrefs such as Order.story now; routes name them in loader options
+    configure_mappers()
+
+    @app.route('/', defaults={'path': ''})
+    @app.route('/<path:path>')
+    def serve(path):
+        static_folder_path = app.static_folder
+        if static_folder_path is None:
+            return "Static folder not configured", 404
+
+        if path != "" and os.path.exists(os.path.join(static_folder_path, path)):
+            return send_from_directory(static_folder_path, path)
         else:
-            return "index.html not found", 404
+            index_path = os.path.join(static_folder_path, 'index.html')
+            if os.path.exists(index_path):
+                return send_from_directory(static_folder_path, 'index.html')
+            else:
+                return "index.html not found", 404
 
-# Health check endpoint
-@app.route('/api/health', methods=['GET'])
-def health_check():
-    return {'status': 'healthy', 'message': 'ZingyBooks API is running'}, 200
+    # Health check endpoint
+    @app.route('/api/health', methods=['GET'])
+    def health_check():
+        return {'status': 'healthy', 'message': 'ZingyBooks API is running'}, 200
+
+    return app
+
+# Built once per process (one cold start on serverless)
+app = create_app()
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
-
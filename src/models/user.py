@@ -1,16 +1,43 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
 from datetime import datetime
-import json
 
 db = SQLAlchemy()
 
+# JSON documents stored natively: JSONB on Postgres, JSON text elsewhere
+JSONType = db.JSON().with_variant(JSONB(), 'postgresql')
+
+class utcnow(FunctionElement):
+    """Current UTC time as a naive timestamp, computed by the database"""
+    type = db.DateTime()
+    inherit_cache = True
+
+@compiles(utcnow)
+def _utcnow_default(element, compiler, **kw):
+    return 'CURRENT_TIMESTAMP'
+
+@compiles(utcnow, 'postgresql')
+def _utcnow_postgresql(element, compiler, **kw):
+    return "TIMEZONE('utc', CURRENT_TIMESTAMP)"
+
+@compiles(utcnow, 'sqlite')
+def _utcnow_sqlite(element, compiler, **kw):
+    return "STRFTIME('%Y-%m-%d %H:%M:%f', 'now')"
+
+@compiles(utcnow, 'mysql')
+def _utcnow_mysql(element, compiler, **kw):
+    return 'UTC_TIMESTAMP(6)'
+
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(255), nullable=True)  # Nullable for Google OAuth users
     google_id = db.Column(db.String(100), nullable=True)
     name = db.Column(db.String(100), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     last_login = db.Column(db.DateTime, default=datetime.utcnow)
     is_active = db.Column(db.Boolean, default=True)
     
@@ -26,11 +53,17 @@ class User(db.Model):
             'id': self.id,
             'email': self.email,
             'name': self.name,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'last_login': self.last_login.isoformat() if self.last_login else None,
+            'created_at': self.created_at,
+            'last_login': self.last_login,
             'is_active': self.is_active
         }
 
+# Keys of Child.to_dict(), in output order
+CHILD_FIELDS = (
+    'id', 'user_id', 'name', 'age', 'birth_date', 'birth_month',
+    'photo_1_url', 'photo_2_url', 'created_at'
+)
+
 class Child(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -49,17 +82,13 @@ class Child(db.Model):
         return f'<Child {self.name}>'
 
     def to_dict(self):
-        return {
-            'id': self.id,
-            'user_id': self.user_id,
-            'name': self.name,
-            'age': self.age,
-            'birth_date': self.birth_date.isoformat() if self.birth_date else None,
-            'birth_month': self.birth_month,
-            'photo_1_url': self.photo_1_url,
-            'photo_2_url': self.photo_2_url,
-            'created_at': self.created_at.isoformat() if self.created_at else None
-        }
+        return {field: getattr(self, field) for field in CHILD_FIELDS}
+
+# Keys of Story.to_dict(), in output order
+STORY_FIELDS = (
+    'id', 'child_id', 'original_idea', 'generated_title', 'generated_summary',
+    'pages_content', 'status', 'created_at', 'updated_at'
+)
 
 class Story(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -67,10 +96,16 @@ class Story(db.Model):
     original_idea = db.Column(db.Text, nullable=False)
     generated_title = db.Column(db.String(200), nullable=True)
     generated_summary = db.Column(db.Text, nullable=True)
-    pages_content = db.Column(db.Text, nullable=True)  # JSON string of all pages
+    pages_content = db.Column(JSONType, nullable=True)  # List of page dicts
     status = db.Column(db.String(20), default='draft')  # draft, approved, completed
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=utcnow())
+    
+    __table_args__ = (
+        db.Index('ix_story_status_created', 'status', 'created_at'),
+    )
+    # Read the database-side updated_at back with RETURNING on each flush
+    __mapper_args__ = {'eager_defaults': True}
     
     # Relationships
     illustrations = db.relationship('Illustration', backref='story', lazy=True, cascade='all, delete-orphan')
@@ -79,70 +114,55 @@ class Story(db.Model):
     def __repr__(self):
         return f'<Story {self.generated_title or "Untitled"}>'
 
-    def get_pages_content(self):
-        """Parse pages_content JSON string"""
-        if self.pages_content:
-            try:
-                return json.loads(self.pages_content)
-            except json.JSONDecodeError:
-                return []
-        return []
-
-    def set_pages_content(self, pages_list):
-        """Set pages_content as JSON string"""
-        self.pages_content = json.dumps(pages_list)
-
     def to_dict(self):
-        return {
-            'id': self.id,
-            'child_id': self.child_id,
-            'original_idea': self.original_idea,
-            'generated_title': self.generated_title,
-            'generated_summary': self.generated_summary,
-            'pages_content': self.get_pages_content(),
-            'status': self.status,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
-        }
+        data = {field: getattr(self, field) for field in STORY_FIELDS}
+        data['pages_content'] = data['pages_content'] or []
+        return data
 
 class Illustration(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     story_id = db.Column(db.Integer, db.ForeignKey('story.id'), nullable=False)
     page_number = db.Column(db.Integer, nullable=False)
     chatgpt_image_url = db.Column(db.String(255), nullable=True)
-    leonardo_images = db.Column(db.Text, nullable=True)  # JSON array of image URLs
+    leonardo_images = db.Column(JSONType, nullable=True)  # List of image URLs
     approved_image_url = db.Column(db.String(255), nullable=True)
     status = db.Column(db.String(20), default='pending')  # pending, approved
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # One illustration per story page; also serves the existence checks
+        # A unique index rather than a constraint, so create_missing_indexes() can add it to existing tables
+        db.Index('uq_illustration_story_page', 'story_id', 'page_number', unique=True),
+    )
+
     def __repr__(self):
         return f'<Illustration Page {self.page_number} for Story {self.story_id}>'
 
-    def get_leonardo_images(self):
-        """Parse leonardo_images JSON string"""
-        if self.leonardo_images:
-            try:
-                return json.loads(self.leonardo_images)
-            except json.JSONDecodeError:
-                return []
-        return []
-
-    def set_leonardo_images(self, images_list):
-        """Set leonardo_images as JSON string"""
-        self.leonardo_images = json.dumps(images_list)
-
     def to_dict(self):
         return {
             'id': self.id,
             'story_id': self.story_id,
             'page_number': self.page_number,
             'chatgpt_image_url': self.chatgpt_image_url,
-            'leonardo_images': self.get_leonardo_images(),
+            'leonardo_images': self.leonardo_images or [],
             'approved_image_url': self.approved_image_url,
             'status': self.status,
-            'created_at': self.created_at.isoformat() if self.created_at else None
+            'created_at': self.created_at
         }
 
+# Valid values for Order.order_status
+ORDER_STATUSES = frozenset({
+    'new_order', 'payment_confirmed', 'processing_illustrations',
+    'customer_approved_book', 'sent_for_printing', 'packed', 'shipped', 'completed'
+})
+
+# Keys of Order.to_dict(), in output order
+ORDER_FIELDS = (
+    'id', 'user_id', 'story_id', 'book_title', 'purchase_option', 'price',
+    'payment_status', 'order_status', 'razorpay_order_id', 'razorpay_payment_id',
+    'shipping_details', 'pdf_file_url', 'created_at', 'updated_at'
+)
+
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -152,46 +172,30 @@ class Order(db.Model):
     price = db.Column(db.Float, nullable=False)
     payment_status = db.Column(db.String(20), default='pending')  # pending, completed, failed
     order_status = db.Column(db.String(30), default='new_order')  # new_order, payment_confirmed, processing_illustrations, customer_approved_book, sent_for_printing, packed, shipped, completed
-    razorpay_order_id = db.Column(db.String(100), nullable=True)
+    razorpay_order_id = db.Column(db.String(100), nullable=True, unique=True, index=True)
     razorpay_payment_id = db.Column(db.String(100), nullable=True)
-    shipping_details = db.Column(db.Text, nullable=True)  # JSON string for shipping info
+    shipping_details = db.Column(JSONType, nullable=True)  # Shipping info dict
     pdf_file_url = db.Column(db.String(255), nullable=True)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=utcnow())
+    
+    # Admin list filters and the completed-revenue reports
+    __table_args__ = (
+        db.Index('ix_order_status_created', 'order_status', 'created_at'),
+        db.Index('ix_order_paystatus_created', 'payment_status', 'created_at'),
+        # Serves the dashboard's monthly revenue GROUP BY on Postgres
+        db.Index('ix_order_month', db.func.date_trunc('month', created_at)).ddl_if(dialect='postgresql'),
+    )
+    # Read the database-side updated_at back with RETURNING on each flush
+    __mapper_args__ = {'eager_defaults': True}
 
     def __repr__(self):
         return f'<Order {self.id} - {self.book_title}>'
 
-    def get_shipping_details(self):
-        """Parse shipping_details JSON string"""
-        if self.shipping_details:
-            try:
-                return json.loads(self.shipping_details)
-            except json.JSONDecodeError:
-                return {}
-        return {}
-
-    def set_shipping_details(self, details_dict):
-        """Set shipping_details as JSON string"""
-        self.shipping_details = json.dumps(details_dict)
-
     def to_dict(self):
-        return {
-            'id': self.id,
-            'user_id': self.user_id,
-            'story_id': self.story_id,
-            'book_title': self.book_title,
-            'purchase_option': self.purchase_option,
-            'price': self.price,
-            'payment_status': self.payment_status,
-            'order_status': self.order_status,
-            'razorpay_order_id': self.razorpay_order_id,
-            'razorpay_payment_id': self.razorpay_payment_id,
-            'shipping_details': self.get_shipping_details(),
-            'pdf_file_url': self.pdf_file_url,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'updated_at': self.updated_at.isoformat() if self.updated_at else None
-        }
+        data = {field: getattr(self, field) for field in ORDER_FIELDS}
+        data['shipping_details'] = data['shipping_details'] or {}
+        return data
 
 # OTP Model for authentication
 class OTP(db.Model):
@@ -202,6 +206,12 @@ class OTP(db.Model):
     expires_at = db.Column(db.DateTime, nullable=False)
     is_used = db.Column(db.Boolean, default=False)
 
+    __table_args__ = (
+        # Serves verify_otp's lookup; partial so used codes drop out of the index
+        db.Index('ix_otp_lookup', email, otp_code, is_used, created_at.desc(),
+                 postgresql_where=is_used == db.false(), sqlite_where=is_used == db.false()),
+    )
+
     def __repr__(self):
         return f'<OTP {self.email}>'
 
@@ -212,8 +222,31 @@ class OTP(db.Model):
         return {
             'id': self.id,
             'email': self.email,
-            'created_at': self.created_at.isoformat() if self.created_at else None,
-            'expires_at': self.expires_at.isoformat() if self.expires_at else None,
+            'created_at': self.created_at,
+            'expires_at': self.expires_at,
             'is_used': self.is_used
         }
 
+def create_missing_indexes():
+    """Create model indexes missing from tables that already existed, returning the ones that failed"""
+    # db.create_all() skips existing tables, so indexes added to the models later are created here
+    failed = []
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(db.engine, checkfirst=True)
+            except Exception as e:
+                # e.g. a unique index over rows that already hold duplicates
+                failed.append((index.name, e))
+    return failed
+
+def missing_unique_indexes():
+    """Names of the models' unique indexes that the database lacks"""
+    inspector = inspect(db.engine)
+    missing = []
+    for table in db.metadata.sorted_tables:
+        unique_indexes = [index for index in table.indexes if index.unique]
+        if unique_indexes:
+            existing = {index['name'] for index in inspector.get_indexes(table.name)}
+            missing.extend(index.name for index in unique_indexes if index.name not in existing)
+    return missing
@@ -1,18 +1,94 @@
-from flask import Blueprint, request, jsonify
-from src.models.user import db, User, Story, Order, Illustration, Child
+from flask import Blueprint, request, current_app
+from src.models.user import db, User, Story, Order, Child, ORDER_FIELDS, ORDER_STATUSES
 from datetime import datetime, timedelta
-from sqlalchemy import func
+from functools import wraps
+from math import ceil
+import hashlib
+import hmac
+from sqlalchemy import case, func, literal, literal_column
+from sqlalchemy.orm import joinedload, raiseload, selectinload
+from src.utils.cache import TTLCache
+from src.utils.fastjson import json_response
 
 admin_bp = Blueprint('admin', __name__)
 
 # Simple admin authentication (in production, use proper JWT or session management)
+# Passwords are kept as SHA-256 hex digests and compared in constant time
 ADMIN_CREDENTIALS = {
-    'admin@zingybooks.com': 'admin123'  # Demo credentials
+    'admin@zingybooks.com': '240be518fabd2724ddb6f04eeb1da5967448d7e831c08c8fa822809f74c720a9'  # Demo credentials (admin123)
 }
+_UNKNOWN_ADMIN_DIGEST = '0' * 64
 
 def verify_admin(email, password):
     """Verify admin credentials"""
-    return ADMIN_CREDENTIALS.get(email) == password
+    stored_digest = ADMIN_CREDENTIALS.get(email, _UNKNOWN_ADMIN_DIGEST)
+    password_digest = hashlib.sha256(str(password).encode()).hexdigest()
+    # Always run the comparison so unknown emails take the same time as wrong passwords
+    return hmac.compare_digest(stored_digest, password_digest) and email in ADMIN_CREDENTIALS
+
+# List totals polled by the admin UI may lag by up to 30s, saving a COUNT(*) per page load
+_list_count_cache = TTLCache(maxsize=64, ttl=30)
+
+def paginate_with_cached_count(query, count_key, page, per_page):
+    """Fetch one page of query, reusing a recently computed total for count_key"""
+    page = page if page >= 1 else 1
+    per_page = per_page if per_page >= 1 else 20
+    
+    total = _list_count_cache.get(count_key)
+    if total is None:
+        total = query.order_by(None).count()
+        _list_count_cache.set(count_key, total)
+    
+    items = query.limit(per_page).offset((page - 1) * per_page).all()
+    pages = ceil(total / per_page) if total else 0
+    
+    return items, {
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'pages': pages,
+        'has_next': page < pages,
+        'has_prev': page > 1
+    }
+
+# Same fields as Order.to_dict(), read straight from the table for the admin list
+ORDER_LIST_COLUMNS = tuple(getattr(Order, field) for field in ORDER_FIELDS)
+
+# Dashboard and analytics are polled by the admin UI and tolerate ~15s of staleness
+_report_cache = TTLCache(maxsize=8, ttl=15)
+
+def cached_report(view):
+    """Serve a recent copy of an admin report and answer If-None-Match with 304"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        cached = _report_cache.get(request.path)
+        if cached is None:
+            response = current_app.make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            body = response.get_data()
+            cached = (body, hashlib.blake2b(body, digest_size=16).hexdigest())
+            _report_cache.set(request.path, cached)
+        
+        body, etag = cached
+        response = current_app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        return response.make_conditional(request)
+    return wrapper
+
+def month_bucket(column):
+    """Group-by expression for the calendar month of a timestamp column"""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        # Inline 'month' so the expression matches the ix_order_month index on Order
+        return func.date_trunc(literal_column("'month'"), column)
+    if dialect in ('mysql', 'mariadb'):
+        return func.date_format(column, '%Y-%m')
+    return func.strftime('%Y-%m', column)
+
+def format_month(month):
+    """Render a month_bucket() value as YYYY-MM"""
+    return month if isinstance(month, str) else month.strftime('%Y-%m')
 
 @admin_bp.route('/admin/login', methods=['POST'])
 def admin_login():
@@ -20,81 +96,85 @@ def admin_login():
         data = request.get_json()
         
         if not data or not data.get('email') or not data.get('password'):
-            return jsonify({'error': 'Email and password are required'}), 400
+            return json_response({'error': 'Email and password are required'}, 400)
         
         email = data['email'].lower().strip()
         password = data['password']
         
         if verify_admin(email, password):
-            return jsonify({
+            return json_response({
                 'message': 'Admin login successful',
                 'admin': {
                     'email': email,
                     'role': 'admin',
-                    'login_time': datetime.utcnow().isoformat()
+                    'login_time': datetime.utcnow()
                 }
-            }), 200
+            }, 200)
         else:
-            return jsonify({'error': 'Invalid admin credentials'}), 401
+            return json_response({'error': 'Invalid admin credentials'}, 401)
             
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @admin_bp.route('/admin/dashboard', methods=['GET'])
+@cached_report
 def admin_dashboard():
     try:
-        # Get dashboard statistics
-        total_users = User.query.count()
-        total_stories = Story.query.count()
-        total_orders = Order.query.count()
-        completed_orders = Order.query.filter_by(payment_status='completed').count()
-        
-        # Revenue calculation
-        completed_order_objects = Order.query.filter_by(payment_status='completed').all()
-        total_revenue = sum(order.price for order in completed_order_objects)
+        # Headline counts and revenue in a single round trip
+        stats = db.session.query(
+            db.session.query(func.count(User.id)).scalar_subquery().label('total_users'),
+            db.session.query(func.count(Story.id)).scalar_subquery().label('total_stories'),
+            func.count(Order.id).label('total_orders'),
+            func.coalesce(func.sum(case((Order.payment_status == 'completed', 1), else_=0)), 0).label('completed_orders'),
+            func.coalesce(func.sum(case((Order.payment_status == 'completed', Order.price), else_=0)), 0).label('total_revenue')
+        ).select_from(Order).one()
+        total_orders = stats.total_orders
+        completed_orders = stats.completed_orders
         
         # Recent orders (last 10)
         recent_orders = Order.query.order_by(Order.created_at.desc()).limit(10).all()
         
-        # Orders by status
+        # Orders by status and by type, fetched together
         order_statuses = db.session.query(
-            Order.order_status,
+            literal('status').label('dimension'),
+            Order.order_status.label('value'),
             func.count(Order.id).label('count')
-        ).group_by(Order.order_status).all()
-        
-        # Orders by type
+        ).group_by(Order.order_status)
         order_types = db.session.query(
-            Order.purchase_option,
+            literal('type').label('dimension'),
+            Order.purchase_option.label('value'),
             func.count(Order.id).label('count')
-        ).group_by(Order.purchase_option).all()
+        ).group_by(Order.purchase_option)
+        order_breakdown = order_statuses.union_all(order_types).all()
         
         # Monthly revenue (last 6 months)
         six_months_ago = datetime.utcnow() - timedelta(days=180)
+        order_month = month_bucket(Order.created_at)
         monthly_revenue = db.session.query(
-            func.strftime('%Y-%m', Order.created_at).label('month'),
+            order_month.label('month'),
             func.sum(Order.price).label('revenue')
         ).filter(
             Order.payment_status == 'completed',
             Order.created_at >= six_months_ago
-        ).group_by(func.strftime('%Y-%m', Order.created_at)).all()
+        ).group_by(order_month).order_by(order_month).all()
         
-        return jsonify({
+        return json_response({
             'stats': {
-                'total_users': total_users,
-                'total_stories': total_stories,
+                'total_users': stats.total_users,
+                'total_stories': stats.total_stories,
                 'total_orders': total_orders,
                 'completed_orders': completed_orders,
-                'total_revenue': total_revenue,
+                'total_revenue': stats.total_revenue,
                 'conversion_rate': round((completed_orders / total_orders * 100) if total_orders > 0 else 0, 2)
             },
             'recent_orders': [order.to_dict() for order in recent_orders],
-            'order_statuses': [{'status': status, 'count': count} for status, count in order_statuses],
-            'order_types': [{'type': type_name, 'count': count} for type_name, count in order_types],
-            'monthly_revenue': [{'month': month, 'revenue': float(revenue or 0)} for month, revenue in monthly_revenue]
-        }), 200
+            'order_statuses': [{'status': value, 'count': count} for dimension, value, count in order_breakdown if dimension == 'status'],
+            'order_types': [{'type': value, 'count': count} for dimension, value, count in order_breakdown if dimension == 'type'],
+            'monthly_revenue': [{'month': format_month(month), 'revenue': float(revenue or 0)} for month, revenue in monthly_revenue]
+        }, 200)
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @admin_bp.route('/admin/orders', methods=['GET'])
 def admin_get_orders():
@@ -103,79 +183,73 @@ def admin_get_orders():
         per_page = request.args.get('per_page', 20, type=int)
         status_filter = request.args.get('status')
         
-        query = Order.query
+        # Plain column rows: no ORM identity map or attribute instrumentation per order
+        query = db.session.query(*ORDER_LIST_COLUMNS)
         
         if status_filter:
-            query = query.filter_by(order_status=status_filter)
+            query = query.filter(Order.order_status == status_filter)
         
-        orders = query.order_by(Order.created_at.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
+        rows, pagination = paginate_with_cached_count(
+            query.order_by(Order.created_at.desc()), ('orders', status_filter), page, per_page
         )
         
-        return jsonify({
-            'orders': [order.to_dict() for order in orders.items],
-            'pagination': {
-                'page': page,
-                'per_page': per_page,
-                'total': orders.total,
-                'pages': orders.pages,
-                'has_next': orders.has_next,
-                'has_prev': orders.has_prev
-            }
-        }), 200
+        orders = []
+        for row in rows:
+            order = dict(row._mapping)
+            order['shipping_details'] = order['shipping_details'] or {}
+            orders.append(order)
+        
+        return json_response({
+            'orders': orders,
+            'pagination': pagination
+        }, 200)
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @admin_bp.route('/admin/orders/<int:order_id>', methods=['GET'])
 def admin_get_order_details(order_id):
     try:
-        order = Order.query.get(order_id)
+        order = db.session.get(Order, order_id, options=[
+            joinedload(Order.story).joinedload(Story.child),
+            joinedload(Order.story).selectinload(Story.illustrations),
+            joinedload(Order.user)
+        ])
         if not order:
-            return jsonify({'error': 'Order not found'}), 404
+            return json_response({'error': 'Order not found'}, 404)
         
         # Include full details
         order_dict = order.to_dict()
         order_dict['story'] = order.story.to_dict()
         order_dict['child'] = order.story.child.to_dict()
         order_dict['user'] = order.user.to_dict()
+        order_dict['illustrations'] = [ill.to_dict() for ill in order.story.illustrations]
         
-        # Get illustrations
-        illustrations = Illustration.query.filter_by(story_id=order.story_id).all()
-        order_dict['illustrations'] = [ill.to_dict() for ill in illustrations]
-        
-        return jsonify({
+        return json_response({
             'order': order_dict
-        }), 200
+        }, 200)
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @admin_bp.route('/admin/orders/<int:order_id>/update-status', methods=['PUT'])
 def admin_update_order_status(order_id):
     try:
         data = request.get_json()
-        order = Order.query.get(order_id)
+        order = db.session.get(Order, order_id)
         if not order:
-            return jsonify({'error': 'Order not found'}), 404
+            return json_response({'error': 'Order not found'}, 404)
         
         new_status = data.get('status')
         notes = data.get('notes', '')
         
         if not new_status:
-            return jsonify({'error': 'Status is required'}), 400
-        
-        # Valid order statuses
-        valid_statuses = [
-            'new_order', 'payment_confirmed', 'processing_illustrations',
-            'customer_approved_book', 'sent_for_printing', 'packed', 'shipped', 'completed'
-        ]
+            return json_response({'error': 'Status is required'}, 400)
         
-        if new_status not in valid_statuses:
-            return jsonify({'error': 'Invalid status'}), 400
+        if new_status not in ORDER_STATUSES:
+            return json_response({'error': 'Invalid status'}, 400)
         
         order.order_status = new_status
-        order.updated_at = datetime.utcnow()
         
         # If completing PDF order, generate PDF URL
         if new_status == 'completed' and order.purchase_option == 'pdf' and not order.pdf_file_url:
@@ -183,14 +257,14 @@ def admin_update_order_status(order_id):
         
         db.session.commit()
         
-        return jsonify({
+        return json_response({
             'message': 'Order status updated successfully',
             'order': order.to_dict()
-        }), 200
+        }, 200)
         
     except Exception as e:
         db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @admin_bp.route('/admin/users', methods=['GET'])
 def admin_get_users():
@@ -198,24 +272,18 @@ def admin_get_users():
         page = request.args.get('page', 1, type=int)
         per_page = request.args.get('per_page', 20, type=int)
         
-        users = User.query.order_by(User.created_at.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
+        # to_dict() only reads columns; fail loudly instead of lazy-loading per row
+        users, pagination = paginate_with_cached_count(
+            User.query.options(raiseload('*')).order_by(User.created_at.desc()), ('users',), page, per_page
         )
         
-        return jsonify({
-            'users': [user.to_dict() for user in users.items],
-            'pagination': {
-                'page': page,
-                'per_page': per_page,
-                'total': users.total,
-                'pages': users.pages,
-                'has_next': users.has_next,
-                'has_prev': users.has_prev
-            }
-        }), 200
+        return json_response({
+            'users': [user.to_dict() for user in users],
+            'pagination': pagination
+        }, 200)
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @admin_bp.route('/admin/stories', methods=['GET'])
 def admin_get_stories():
@@ -224,54 +292,48 @@ def admin_get_stories():
         per_page = request.args.get('per_page', 20, type=int)
         status_filter = request.args.get('status')
         
-        query = Story.query
+        query = Story.query.options(raiseload('*'))
         
         if status_filter:
             query = query.filter_by(status=status_filter)
         
-        stories = query.order_by(Story.created_at.desc()).paginate(
-            page=page, per_page=per_page, error_out=False
+        stories, pagination = paginate_with_cached_count(
+            query.order_by(Story.created_at.desc()), ('stories', status_filter), page, per_page
         )
         
-        return jsonify({
-            'stories': [story.to_dict() for story in stories.items],
-            'pagination': {
-                'page': page,
-                'per_page': per_page,
-                'total': stories.total,
-                'pages': stories.pages,
-                'has_next': stories.has_next,
-                'has_prev': stories.has_prev
-            }
-        }), 200
+        return json_response({
+            'stories': [story.to_dict() for story in stories],
+            'pagination': pagination
+        }, 200)
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @admin_bp.route('/admin/stories/<int:story_id>', methods=['GET'])
 def admin_get_story_details(story_id):
     try:
-        story = Story.query.get(story_id)
+        story = db.session.get(Story, story_id, options=[
+            joinedload(Story.child).joinedload(Child.user),
+            selectinload(Story.illustrations)
+        ])
         if not story:
-            return jsonify({'error': 'Story not found'}), 404
+            return json_response({'error': 'Story not found'}, 404)
         
         # Include full details
         story_dict = story.to_dict()
         story_dict['child'] = story.child.to_dict()
         story_dict['user'] = story.child.user.to_dict()
+        story_dict['illustrations'] = [ill.to_dict() for ill in story.illustrations]
         
-        # Get illustrations
-        illustrations = Illustration.query.filter_by(story_id=story_id).all()
-        story_dict['illustrations'] = [ill.to_dict() for ill in illustrations]
-        
-        return jsonify({
+        return json_response({
             'story': story_dict
-        }), 200
+        }, 200)
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
 @admin_bp.route('/admin/analytics', methods=['GET'])
+@cached_report
 def admin_analytics():
     try:
         # User registration trends (last 30 days)
@@ -284,30 +346,33 @@ def admin_analytics():
         ).group_by(func.date(User.created_at)).all()
         
         # Story completion rates
-        total_stories = Story.query.count()
-        approved_stories = Story.query.filter_by(status='approved').count()
+        total_stories, approved_stories = db.session.query(
+            func.count(Story.id),
+            func.coalesce(func.sum(case((Story.status == 'approved', 1), else_=0)), 0)
+        ).one()
         
         # Order conversion funnel
-        total_approved_stories = Story.query.filter_by(status='approved').count()
-        total_paid_orders = Order.query.filter_by(payment_status='completed').count()
+        paid_revenue, total_paid_orders = db.session.query(
+            func.coalesce(func.sum(Order.price), 0),
+            func.count(Order.id)
+        ).filter(Order.payment_status == 'completed').one()
         
         # Average order value
-        completed_orders = Order.query.filter_by(payment_status='completed').all()
-        avg_order_value = sum(order.price for order in completed_orders) / len(completed_orders) if completed_orders else 0
+        avg_order_value = paid_revenue / total_paid_orders if total_paid_orders else 0
         
-        return jsonify({
+        return json_response({
             'daily_registrations': [
                 {'date': str(date), 'count': count} 
                 for date, count in daily_registrations
             ],
             'story_completion_rate': round((approved_stories / total_stories * 100) if total_stories > 0 else 0, 2),
-            'order_conversion_rate': round((total_paid_orders / total_approved_stories * 100) if total_approved_stories > 0 else 0, 2),
+            'order_conversion_rate': round((total_paid_orders / approved_stories * 100) if approved_stories > 0 else 0, 2),
             'average_order_value': round(avg_order_value, 2),
             'total_stories': total_stories,
             'approved_stories': approved_stories,
             'total_paid_orders': total_paid_orders
-        }), 200
+        }, 200)
         
     except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        return json_response({'error': str(e)}, 500)
 
@@ -1,32 +1,105 @@
 from flask import Blueprint, request, jsonify
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
 from src.models.user import db, User, OTP
+from src.utils.cache import TTLCache
+from sqlalchemy import delete, false, func, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
 from datetime import datetime, timedelta
-import random
-import string
 import re
+import secrets
 
 auth_bp = Blueprint('auth', __name__)
 
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+
+# One shared hasher; argon2id at roughly the OWASP minimum cost
+_password_hasher = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+
+# Dialects with INSERT ... ON CONFLICT support, used by upsert_user()
+_UPSERT_INSERTS = {'postgresql': pg_insert, 'sqlite': sqlite_insert}
+
+# OTP requests per email in the current window; send_otp allows OTP_SEND_LIMIT per minute
+OTP_SEND_LIMIT = 3
+_otp_send_counts = TTLCache(maxsize=10000, ttl=60)
+
+# Marks a recent purge of expired OTPs; each process purges at most once an hour
+_otp_purge_marker = TTLCache(maxsize=1, ttl=3600)
+
 def generate_otp():
     """Generate a 6-digit OTP"""
-    return ''.join(random.choices(string.digits, k=6))
+    return f"{secrets.randbelow(1000000):06d}"
+
+def purge_expired_otps():
+    """Delete OTPs that expired more than a day ago, unless this process did so within the hour"""
+    if _otp_purge_marker.get('purged'):
+        return
+    _otp_purge_marker.set('purged', True)
+    db.session.execute(delete(OTP).where(OTP.expires_at < datetime.utcnow() - timedelta(days=1)))
+
+def hash_password(password):
+    """Hash a password with argon2id"""
+    return _password_hasher.hash(password)
+
+def verify_password(user, password):
+    """Check password against the user's hash, upgrading legacy Werkzeug hashes on success"""
+    if not user.password_hash.startswith('$argon2'):
+        if not check_password_hash(user.password_hash, password):
+            return False
+        user.password_hash = hash_password(password)
+        return True
+
+    try:
+        _password_hasher.verify(user.password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+    if _password_hasher.check_needs_rehash(user.password_hash):
+        user.password_hash = hash_password(password)
+    return True
+
+def upsert_user(values, on_conflict):
+    """Insert a user, or apply on_conflict to the existing user with the same email, and return it"""
+    dialect_insert = _UPSERT_INSERTS.get(db.session.get_bind().dialect.name)
+    if dialect_insert is None:
+        user = User.query.filter_by(email=values['email']).first()
+        if not user:
+            user = User(**values)
+            db.session.add(user)
+        else:
+            for key, value in on_conflict.items():
+                setattr(user, key, value)
+        db.session.flush()
+        return user
+
+    stmt = (
+        dialect_insert(User)
+        .values(**values)
+        .on_conflict_do_update(index_elements=[User.email], set_=on_conflict)
+        .returning(User)
+    )
+    return db.session.scalars(stmt, execution_options={'populate_existing': True}).one()
+
+def normalize_email(email):
+    """Canonical form of an email address for storage and lookups"""
+    return email.strip().lower()
 
 def is_valid_email(email):
     """Validate email format"""
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    return _EMAIL_RE.match(email) is not None
 
 @auth_bp.route('/auth/register', methods=['POST'])
 def register():
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True, cache=False)
         
         # Validate required fields
         if not data or not data.get('email') or not data.get('name'):
             return jsonify({'error': 'Email and name are required'}), 400
         
-        email = data['email'].lower().strip()
+        email = normalize_email(data['email'])
         name = data['name'].strip()
         password = data.get('password', '')
         
@@ -34,13 +107,8 @@ def register():
         if not is_valid_email(email):
             return jsonify({'error': 'Invalid email format'}), 400
         
-        # Check if user already exists
-        existing_user = User.query.filter_by(email=email).first()
-        if existing_user:
-            return jsonify({'error': 'User with this email already exists'}), 400
-        
-        # Create new user
-        password_hash = generate_password_hash(password) if password else None
+        # Create new user; the unique email constraint rejects duplicates
+        password_hash = hash_password(password) if password else None
         user = User(
             email=email,
             name=name,
@@ -55,6 +123,9 @@ def register():
             'user': user.to_dict()
         }), 201
         
+    except IntegrityError:
+        db.session.rollback()
+        return jsonify({'error': 'User with this email already exists'}), 400
     except Exception as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
@@ -62,12 +133,12 @@ def register():
 @auth_bp.route('/auth/login', methods=['POST'])
 def login():
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True, cache=False)
         
         if not data or not data.get('email'):
             return jsonify({'error': 'Email is required'}), 400
         
-        email = data['email'].lower().strip()
+        email = normalize_email(data['email'])
         password = data.get('password', '')
         
         # Find user
@@ -77,7 +148,7 @@ def login():
         
         # Check password if provided
         if user.password_hash and password:
-            if not check_password_hash(user.password_hash, password):
+            if not verify_password(user, password):
                 return jsonify({'error': 'Invalid password'}), 401
         elif user.password_hash and not password:
             return jsonify({'error': 'Password is required'}), 401
@@ -97,32 +168,21 @@ def login():
 @auth_bp.route('/auth/google', methods=['POST'])
 def google_auth():
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True, cache=False)
         
         if not data or not data.get('email') or not data.get('google_id'):
             return jsonify({'error': 'Email and Google ID are required'}), 400
         
-        email = data['email'].lower().strip()
+        email = normalize_email(data['email'])
         google_id = data['google_id']
         name = data.get('name', email.split('@')[0])
         
-        # Check if user exists
-        user = User.query.filter_by(email=email).first()
-        
-        if user:
-            # Update Google ID if not set
-            if not user.google_id:
-                user.google_id = google_id
-            user.last_login = datetime.utcnow()
-        else:
-            # Create new user
-            user = User(
-                email=email,
-                name=name,
-                google_id=google_id
-            )
-            db.session.add(user)
-        
+        # Create the user or, if the email exists, keep any Google ID already linked
+        now = datetime.utcnow()
+        user = upsert_user(
+            {'email': email, 'name': name, 'google_id': google_id, 'created_at': now, 'last_login': now},
+            {'google_id': func.coalesce(User.google_id, google_id), 'last_login': now}
+        )
         db.session.commit()
         
         return jsonify({
@@ -137,21 +197,36 @@ def google_auth():
 @auth_bp.route('/auth/send-otp', methods=['POST'])
 def send_otp():
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True, cache=False)
         
         if not data or not data.get('email'):
             return jsonify({'error': 'Email is required'}), 400
         
-        email = data['email'].lower().strip()
+        email = normalize_email(data['email'])
         
         # Validate email format
         if not is_valid_email(email):
             return jsonify({'error': 'Invalid email format'}), 400
         
+        # Rate limit per email before doing any work; a full counter table refuses too,
+        # rather than forgetting a live count that a flood of other emails would push out
+        send_count = _otp_send_counts.incr(email)
+        if send_count is None or send_count > OTP_SEND_LIMIT:
+            return jsonify({'error': 'Too many OTP requests, please try again later'}), 429
+        
         # Generate OTP
         otp_code = generate_otp()
         expires_at = datetime.utcnow() + timedelta(minutes=10)  # OTP expires in 10 minutes
         
+        # Only the newest code stays valid; old rows are cleared out periodically
+        db.session.execute(
+            update(OTP)
+            .where(OTP.email == email, OTP.is_used == false())
+            .values(is_used=True)
+            .execution_options(synchronize_session=False)
+        )
+        purge_expired_otps()
+        
         # Save OTP to database
         otp = OTP(
             email=email,
@@ -166,7 +241,7 @@ def send_otp():
         return jsonify({
             'message': 'OTP sent successfully',
             'otp': otp_code,  # Remove this in production
-            'expires_at': expires_at.isoformat()
+            'expires_at': expires_at
         }), 200
         
     except Exception as e:
@@ -176,40 +251,38 @@ def send_otp():
 @auth_bp.route('/auth/verify-otp', methods=['POST'])
 def verify_otp():
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True, cache=False)
         
         if not data or not data.get('email') or not data.get('otp'):
             return jsonify({'error': 'Email and OTP are required'}), 400
         
-        email = data['email'].lower().strip()
+        email = normalize_email(data['email'])
         otp_code = data['otp']
         
-        # Find the most recent unused OTP for this email
-        otp = OTP.query.filter_by(
-            email=email,
-            otp_code=otp_code,
-            is_used=False
-        ).order_by(OTP.created_at.desc()).first()
-        
-        if not otp:
-            return jsonify({'error': 'Invalid OTP'}), 400
-        
-        if otp.is_expired():
-            return jsonify({'error': 'OTP has expired'}), 400
-        
-        # Mark OTP as used
-        otp.is_used = True
-        db.session.commit()
-        
-        # Check if user exists, create if not
-        user = User.query.filter_by(email=email).first()
-        if not user:
-            user = User(
-                email=email,
-                name=email.split('@')[0]  # Use email prefix as default name
+        # Consume a matching unexpired OTP in one atomic statement, so a code verifies only once
+        consumed = db.session.execute(
+            update(OTP)
+            .where(
+                OTP.email == email,
+                OTP.otp_code == otp_code,
+                OTP.is_used == false(),
+                OTP.expires_at > datetime.utcnow()
             )
-            db.session.add(user)
-            db.session.commit()
+            .values(is_used=True)
+            .returning(OTP.id)
+            .execution_options(synchronize_session=False)
+        ).first()
+        
+        if consumed is None:
+            return jsonify({'error': 'Invalid or expired OTP'}), 400
+        
+        # Create the user on first sign-in (email prefix as default name), otherwise record the login
+        now = datetime.utcnow()
+        user = upsert_user(
+            {'email': email, 'name': email.split('@')[0], 'created_at': now, 'last_login': now},
+            {'last_login': now}
+        )
+        db.session.commit()
         
         return jsonify({
             'message': 'OTP verified successfully',
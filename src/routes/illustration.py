@@ -1,5 +1,6 @@
 from flask import Blueprint, request, jsonify
 from src.models.user import db, Story, Illustration
+from sqlalchemy import insert
 from datetime import datetime
 
 illustration_bp = Blueprint('illustration', __name__)
@@ -7,8 +8,7 @@ illustration_bp = Blueprint('illustration', __name__)
 @illustration_bp.route('/illustrations/story/<int:story_id>', methods=['GET'])
 def get_story_illustrations(story_id):
     try:
-        story = Story.query.get(story_id)
-        if not story:
+        if not db.session.scalar(db.select(db.exists().where(Story.id == story_id))):
             return jsonify({'error': 'Story not found'}), 404
         
         illustrations = Illustration.query.filter_by(story_id=story_id).order_by(Illustration.page_number).all()
@@ -29,43 +29,43 @@ def generate_illustrations(story_id):
         if not story:
             return jsonify({'error': 'Story not found'}), 404
         
-        pages_content = story.get_pages_content()
+        pages_content = story.pages_content
         if not pages_content:
             return jsonify({'error': 'Story content not found'}), 400
         
-        # Generate illustrations for each page (simulate AI generation)
-        generated_count = 0
-        for page in pages_content:
-            page_number = page['page_number']
-            
-            # Check if illustration already exists
-            existing_illustration = Illustration.query.filter_by(
-                story_id=story_id,
-                page_number=page_number
-            ).first()
-            
-            if not existing_illustration:
+        # Pages that already have an illustration, fetched in one query
+        # Repeated page numbers count once, since illustrations are unique per story page
+        page_numbers = list(dict.fromkeys(page['page_number'] for page in pages_content))
+        existing_pages = set(db.session.scalars(
+            db.select(Illustration.page_number).where(
+                Illustration.story_id == story_id,
+                Illustration.page_number.in_(page_numbers)
+            )
+        ))
+        
+        # Generate illustrations for each remaining page (simulate AI generation)
+        rows = []
+        for page_number in page_numbers:
+            if page_number in existing_pages:
+                continue
+            rows.append({
+                'story_id': story_id,
+                'page_number': page_number,
                 # Simulate ChatGPT image generation
-                chatgpt_image_url = f"/api/generated/chatgpt/story_{story_id}_page_{page_number}.jpg"
-                
+                'chatgpt_image_url': f"/api/generated/chatgpt/story_{story_id}_page_{page_number}.jpg",
                 # Simulate Leonardo.ai image generation (2 images per page)
-                leonardo_images = [
+                'leonardo_images': [
                     f"/api/generated/leonardo/story_{story_id}_page_{page_number}_option_1.jpg",
                     f"/api/generated/leonardo/story_{story_id}_page_{page_number}_option_2.jpg"
-                ]
-                
-                illustration = Illustration(
-                    story_id=story_id,
-                    page_number=page_number,
-                    chatgpt_image_url=chatgpt_image_url,
-                    status='pending'
-                )
-                illustration.set_leonardo_images(leonardo_images)
-                
-                db.session.add(illustration)
-                generated_count += 1
+                ],
+                'status': 'pending'
+            })
         
+        # One multi-row INSERT for the whole batch
+        if rows:
+            db.session.execute(insert(Illustration), rows)
         db.session.commit()
+        generated_count = len(rows)
         
         return jsonify({
             'message': f'Generated {generated_count} illustrations',
@@ -118,7 +118,7 @@ def regenerate_illustration(illustration_id):
             f"/api/generated/leonardo/story_{illustration.story_id}_page_{illustration.page_number}_option_1_{timestamp}.jpg",
             f"/api/generated/leonardo/story_{illustration.story_id}_page_{illustration.page_number}_option_2_{timestamp}.jpg"
         ]
-        illustration.set_leonardo_images(leonardo_images)
+        illustration.leonardo_images = leonardo_images
         illustration.status = 'pending'
         illustration.approved_image_url = None
         
@@ -136,16 +136,18 @@ def regenerate_illustration(illustration_id):
 @illustration_bp.route('/illustrations/story/<int:story_id>/approved-count', methods=['GET'])
 def get_approved_illustrations_count(story_id):
     try:
-        story = Story.query.get(story_id)
-        if not story:
+        if not db.session.scalar(db.select(db.exists().where(Story.id == story_id))):
             return jsonify({'error': 'Story not found'}), 404
         
-        approved_count = Illustration.query.filter_by(
-            story_id=story_id,
-            status='approved'
-        ).count()
-        
-        total_count = Illustration.query.filter_by(story_id=story_id).count()
+        # Illustration counts per status, in one grouped query
+        status_counts = dict(
+            db.session.query(Illustration.status, db.func.count(Illustration.id))
+            .filter_by(story_id=story_id)
+            .group_by(Illustration.status)
+            .all()
+        )
+        approved_count = status_counts.get('approved', 0)
+        total_count = sum(status_counts.values())
         
         return jsonify({
             'approved_count': approved_count,
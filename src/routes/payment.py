@@ -1,9 +1,15 @@
-from flask import Blueprint, request, jsonify
-from src.models.user import db, User, Story, Order, Illustration
+from flask import Blueprint, request, jsonify, current_app
+from src.models.user import db, User, Child, Story, Order, Illustration, ORDER_STATUSES
+from sqlalchemy import and_, case, cast, update
+from sqlalchemy.orm import joinedload
+from src.utils import fastjson
 from datetime import datetime
+import hashlib
+import hmac
 import json
-import random
-import string
+import logging
+import os
+import secrets
 
 payment_bp = Blueprint('payment', __name__)
 
@@ -14,57 +20,82 @@ PRICING = {
     'hard': 1897     # ₹1897 for Hardcover Premium Book
 }
 
+# Pricing is static configuration, so the response body and its ETag are built once
+_PRICING_PAYLOAD = fastjson.dumpb({
+    'pricing': PRICING,
+    'currency': 'INR',
+    'options': [
+        {
+            'type': 'pdf',
+            'name': 'PDF Digital Book',
+            'price': PRICING['pdf'],
+            'description': 'Instant download, high-quality PDF format',
+            'delivery': 'Immediate digital delivery',
+            'features': ['24-page personalized story', 'High-resolution illustrations', 'Instant download']
+        },
+        {
+            'type': 'paper',
+            'name': 'Paperback Printed Book',
+            'price': PRICING['paper'],
+            'description': 'Physical paperback book with premium printing',
+            'delivery': '7-10 business days',
+            'features': ['24-page personalized story', 'High-quality paperback printing', 'Free shipping in India']
+        },
+        {
+            'type': 'hard',
+            'name': 'Hardcover Premium Book',
+            'price': PRICING['hard'],
+            'description': 'Premium hardcover book with dust jacket',
+            'delivery': '7-10 business days',
+            'features': ['24-page personalized story', 'Premium hardcover binding', 'Dust jacket included', 'Free shipping in India']
+        }
+    ]
+})
+_PRICING_ETAG = hashlib.blake2b(_PRICING_PAYLOAD, digest_size=16).hexdigest()
+
+# Book types that ship physically and take shipping details
+PHYSICAL_BOOK_TYPES = frozenset({'paper', 'hard'})
+
+# Razorpay secrets; while one is unset its signatures are rejected,
+# unless RAZORPAY_DEMO_MODE=1 explicitly accepts them unchecked
+RAZORPAY_KEY_SECRET = os.environ.get('RAZORPAY_KEY_SECRET')
+RAZORPAY_WEBHOOK_SECRET = os.environ.get('RAZORPAY_WEBHOOK_SECRET')
+RAZORPAY_DEMO_MODE = os.environ.get('RAZORPAY_DEMO_MODE') == '1'
+
+if not (RAZORPAY_KEY_SECRET and RAZORPAY_WEBHOOK_SECRET):
+    logging.getLogger(__name__).warning(
+        'Razorpay secrets are not fully configured; unsigned payments are %s',
+        'accepted (RAZORPAY_DEMO_MODE)' if RAZORPAY_DEMO_MODE else 'rejected'
+    )
+
+def is_valid_signature(secret, message, signature):
+    """Check a Razorpay HMAC-SHA256 hex signature in constant time"""
+    if not secret:
+        return RAZORPAY_DEMO_MODE
+    if not isinstance(signature, str):
+        return False
+    expected = hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+    # Compare bytes; compare_digest rejects non-ASCII str arguments with TypeError
+    return hmac.compare_digest(expected.encode(), signature.encode())
+
 def generate_order_id():
     """Generate a unique order ID"""
-    timestamp = str(int(datetime.utcnow().timestamp()))
-    random_str = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-    return f"ZB{timestamp}{random_str}"
+    return f"ZB{int(datetime.utcnow().timestamp())}{secrets.token_hex(3).upper()}"
 
 def generate_razorpay_order_id():
     """Simulate Razorpay order ID generation"""
-    return f"order_{''.join(random.choices(string.ascii_lowercase + string.digits, k=14))}"
+    return f"order_{secrets.token_hex(7)}"
 
 def generate_razorpay_payment_id():
     """Simulate Razorpay payment ID generation"""
-    return f"pay_{''.join(random.choices(string.ascii_lowercase + string.digits, k=14))}"
+    return f"pay_{secrets.token_hex(7)}"
 
 @payment_bp.route('/payment/pricing', methods=['GET'])
 def get_pricing():
     """Get pricing information for all book types"""
-    try:
-        return jsonify({
-            'pricing': PRICING,
-            'currency': 'INR',
-            'options': [
-                {
-                    'type': 'pdf',
-                    'name': 'PDF Digital Book',
-                    'price': PRICING['pdf'],
-                    'description': 'Instant download, high-quality PDF format',
-                    'delivery': 'Immediate digital delivery',
-                    'features': ['24-page personalized story', 'High-resolution illustrations', 'Instant download']
-                },
-                {
-                    'type': 'paper',
-                    'name': 'Paperback Printed Book',
-                    'price': PRICING['paper'],
-                    'description': 'Physical paperback book with premium printing',
-                    'delivery': '7-10 business days',
-                    'features': ['24-page personalized story', 'High-quality paperback printing', 'Free shipping in India']
-                },
-                {
-                    'type': 'hard',
-                    'name': 'Hardcover Premium Book',
-                    'price': PRICING['hard'],
-                    'description': 'Premium hardcover book with dust jacket',
-                    'delivery': '7-10 business days',
-                    'features': ['24-page personalized story', 'Premium hardcover binding', 'Dust jacket included', 'Free shipping in India']
-                }
-            ]
-        }), 200
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    response = current_app.response_class(_PRICING_PAYLOAD, mimetype='application/json')
+    response.set_etag(_PRICING_ETAG)
+    return response.make_conditional(request)
 
 @payment_bp.route('/payment/create-order', methods=['POST'])
 def create_payment_order():
@@ -86,26 +117,35 @@ def create_payment_order():
         if book_type not in PRICING:
             return jsonify({'error': 'Invalid book type'}), 400
         
-        # Verify user and story exist
-        user = User.query.get(user_id)
-        if not user:
+        # Verify user and story exist and count approved illustrations, in one query
+        row = db.session.query(
+            Story.id.label('story_id'),
+            Story.status,
+            Story.generated_title,
+            Child.name.label('child_name'),
+            db.func.count(Illustration.id).label('approved_illustrations')
+        ).select_from(User).outerjoin(
+            Story, Story.id == story_id
+        ).outerjoin(
+            Child, Child.id == Story.child_id
+        ).outerjoin(
+            Illustration, and_(Illustration.story_id == Story.id, Illustration.status == 'approved')
+        ).filter(User.id == user_id).group_by(
+            Story.id, Story.status, Story.generated_title, Child.name
+        ).first()
+        
+        if row is None:
             return jsonify({'error': 'User not found'}), 404
             
-        story = Story.query.get(story_id)
-        if not story:
+        if row.story_id is None:
             return jsonify({'error': 'Story not found'}), 404
         
         # Check if story is approved
-        if story.status != 'approved':
+        if row.status != 'approved':
             return jsonify({'error': 'Story must be approved before payment'}), 400
         
         # Check if at least 5 illustrations are approved (as per workflow)
-        approved_illustrations = Illustration.query.filter_by(
-            story_id=story_id,
-            status='approved'
-        ).count()
-        
-        if approved_illustrations < 5:
+        if row.approved_illustrations < 5:
             return jsonify({'error': 'At least 5 illustrations must be approved before payment'}), 400
         
         # Get price
@@ -118,7 +158,7 @@ def create_payment_order():
         order = Order(
             user_id=user_id,
             story_id=story_id,
-            book_title=story.generated_title or f"{story.child.name}'s Story",
+            book_title=row.generated_title or f"{row.child_name}'s Story",
             purchase_option=book_type,
             price=price,
             payment_status='pending',
@@ -127,10 +167,10 @@ def create_payment_order():
         )
         
         # Add shipping details if physical book
-        if book_type in ['paper', 'hard']:
+        if book_type in PHYSICAL_BOOK_TYPES:
             shipping_details = data.get('shipping_details', {})
             if shipping_details:
-                order.set_shipping_details(shipping_details)
+                order.shipping_details = shipping_details
         
         db.session.add(order)
         db.session.commit()
@@ -170,28 +210,32 @@ def verify_payment():
         razorpay_payment_id = data['razorpay_payment_id']
         razorpay_signature = data['razorpay_signature']
         
-        # Find order
-        order = Order.query.filter_by(razorpay_order_id=razorpay_order_id).first()
+        # Reject forged payments before touching the database
+        if not is_valid_signature(
+                RAZORPAY_KEY_SECRET, f"{razorpay_order_id}|{razorpay_payment_id}".encode(), razorpay_signature):
+            return jsonify({'error': 'Invalid payment signature'}), 400
+        
+        # Record the payment in one UPDATE ... RETURNING; PDF orders complete straight away
+        is_pdf = Order.purchase_option == 'pdf'
+        order = db.session.scalars(
+            update(Order)
+            .where(Order.razorpay_order_id == razorpay_order_id)
+            .values(
+                razorpay_payment_id=razorpay_payment_id,
+                payment_status='completed',
+                order_status=case((is_pdf, 'completed'), else_='payment_confirmed'),
+                pdf_file_url=case(
+                    (is_pdf, '/api/generated/pdf/order_' + cast(Order.id, db.String) + '_book.pdf'),
+                    else_=Order.pdf_file_url
+                )
+            )
+            .returning(Order)
+            .execution_options(synchronize_session=False, populate_existing=True)
+        ).first()
         if not order:
             return jsonify({'error': 'Order not found'}), 404
-        
-        # In a real application, you would verify the signature using Razorpay's webhook secret
-        # For demo purposes, we'll simulate successful verification
-        
-        # Update order with payment details
-        order.razorpay_payment_id = razorpay_payment_id
-        order.payment_status = 'completed'
-        order.order_status = 'payment_confirmed'
-        order.updated_at = datetime.utcnow()
-        
         db.session.commit()
         
-        # If PDF order, generate PDF immediately
-        if order.purchase_option == 'pdf':
-            order.pdf_file_url = f"/api/generated/pdf/order_{order.id}_book.pdf"
-            order.order_status = 'completed'
-            db.session.commit()
-        
         return jsonify({
             'message': 'Payment verified successfully',
             'order': order.to_dict(),
@@ -202,31 +246,51 @@ def verify_payment():
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
 
+def handle_payment_captured(payload):
+    """Mark the order paid once Razorpay captures its payment"""
+    payment_entity = payload.get('payment', {}).get('entity', {})
+    order_id = payment_entity.get('order_id')
+    payment_id = payment_entity.get('id')
+    
+    if order_id and payment_id:
+        db.session.execute(
+            update(Order)
+            .where(Order.razorpay_order_id == order_id)
+            .values(razorpay_payment_id=payment_id, payment_status='completed', order_status='payment_confirmed')
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
+
+def handle_payment_failed(payload):
+    """Flag a still-pending order whose payment attempt failed"""
+    order_id = payload.get('payment', {}).get('entity', {}).get('order_id')
+    
+    if order_id:
+        order = Order.query.filter_by(razorpay_order_id=order_id).first()
+        if order and order.payment_status == 'pending':
+            order.payment_status = 'failed'
+            db.session.commit()
+
+# Razorpay webhook event name -> handler taking the event payload
+_WEBHOOK_HANDLERS = {
+    'payment.captured': handle_payment_captured,
+    'payment.failed': handle_payment_failed
+}
+
 @payment_bp.route('/payment/webhook', methods=['POST'])
 def razorpay_webhook():
     """Handle Razorpay webhook notifications"""
     try:
-        data = request.get_json()
-        
-        # In a real application, you would verify the webhook signature
-        # For demo purposes, we'll process the webhook data
+        # Razorpay signs the raw request body with the webhook secret
+        if not is_valid_signature(
+                RAZORPAY_WEBHOOK_SECRET, request.get_data(), request.headers.get('X-Razorpay-Signature')):
+            return jsonify({'error': 'Invalid webhook signature'}), 400
         
-        event = data.get('event')
-        payload = data.get('payload', {})
+        data = request.get_json()
         
-        if event == 'payment.captured':
-            payment_entity = payload.get('payment', {}).get('entity', {})
-            order_id = payment_entity.get('order_id')
-            payment_id = payment_entity.get('id')
-            
-            if order_id and payment_id:
-                order = Order.query.filter_by(razorpay_order_id=order_id).first()
-                if order:
-                    order.razorpay_payment_id = payment_id
-                    order.payment_status = 'completed'
-                    order.order_status = 'payment_confirmed'
-                    order.updated_at = datetime.utcnow()
-                    db.session.commit()
+        handler = _WEBHOOK_HANDLERS.get(data.get('event'))
+        if handler:
+            handler(data.get('payload', {}))
         
         return jsonify({'status': 'ok'}), 200
         
@@ -237,8 +301,7 @@ def razorpay_webhook():
 def get_user_orders(user_id):
     """Get all orders for a user"""
     try:
-        user = User.query.get(user_id)
-        if not user:
+        if not db.session.scalar(db.select(db.exists().where(User.id == user_id))):
             return jsonify({'error': 'User not found'}), 404
         
         orders = Order.query.filter_by(user_id=user_id).order_by(Order.created_at.desc()).all()
@@ -254,7 +317,8 @@ def get_user_orders(user_id):
 def get_order(order_id):
     """Get order details"""
     try:
-        order = Order.query.get(order_id)
+        # Story and child come back in the same query
+        order = db.session.get(Order, order_id, options=[joinedload(Order.story).joinedload(Story.child)])
         if not order:
             return jsonify({'error': 'Order not found'}), 404
         
@@ -283,17 +347,10 @@ def update_order_status(order_id):
         if not new_status:
             return jsonify({'error': 'Status is required'}), 400
         
-        # Valid order statuses
-        valid_statuses = [
-            'new_order', 'payment_confirmed', 'processing_illustrations',
-            'customer_approved_book', 'sent_for_printing', 'packed', 'shipped', 'completed'
-        ]
-        
-        if new_status not in valid_statuses:
+        if new_status not in ORDER_STATUSES:
             return jsonify({'error': 'Invalid status'}), 400
         
         order.order_status = new_status
-        order.updated_at = datetime.utcnow()
         
         # If completing PDF order, generate PDF URL
         if new_status == 'completed' and order.purchase_option == 'pdf' and not order.pdf_file_url:
@@ -314,29 +371,30 @@ def update_order_status(order_id):
 def get_order_stats():
     """Get order statistics for admin dashboard"""
     try:
-        total_orders = Order.query.count()
-        completed_orders = Order.query.filter_by(payment_status='completed').count()
-        pending_orders = Order.query.filter_by(payment_status='pending').count()
-        
-        # Revenue calculation
-        completed_order_objects = Order.query.filter_by(payment_status='completed').all()
-        total_revenue = sum(order.price for order in completed_order_objects)
-        
-        # Orders by type
-        pdf_orders = Order.query.filter_by(purchase_option='pdf', payment_status='completed').count()
-        paper_orders = Order.query.filter_by(purchase_option='paper', payment_status='completed').count()
-        hard_orders = Order.query.filter_by(purchase_option='hard', payment_status='completed').count()
+        # One grouped pass; every figure below is rolled up from these rows
+        rows = db.session.query(
+            Order.purchase_option, Order.payment_status, db.func.count(Order.id), db.func.sum(Order.price)
+        ).group_by(Order.purchase_option, Order.payment_status).all()
+        
+        total_orders = completed_orders = pending_orders = 0
+        total_revenue = 0
+        orders_by_type = {'pdf': 0, 'paper': 0, 'hard': 0}
+        for purchase_option, payment_status, count, revenue in rows:
+            total_orders += count
+            if payment_status == 'pending':
+                pending_orders += count
+            elif payment_status == 'completed':
+                completed_orders += count
+                total_revenue += revenue or 0
+                if purchase_option in orders_by_type:
+                    orders_by_type[purchase_option] += count
         
         return jsonify({
             'total_orders': total_orders,
             'completed_orders': completed_orders,
             'pending_orders': pending_orders,
             'total_revenue': total_revenue,
-            'orders_by_type': {
-                'pdf': pdf_orders,
-                'paper': paper_orders,
-                'hard': hard_orders
-            }
+            'orders_by_type': orders_by_type
         }), 200
         
     except Exception as e:
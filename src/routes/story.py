@@ -1,266 +1,372 @@
-from flask import Blueprint, request, jsonify
+from flask import Blueprint, request, jsonify, current_app, stream_with_context, url_for
+from werkzeug.exceptions import HTTPException
 from src.models.user import db, User, Child, Story, Illustration
 from src.services.ai_services import chatgpt_service, leonardo_service
+from src.utils import fastjson
+from src.utils.cache import TTLCache
+from sqlalchemy import func, insert, update
+from sqlalchemy.orm import joinedload
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from functools import partial
+from itertools import chain, islice
+import asyncio
 import json
 
 story_bp = Blueprint('story', __name__)
 
+# Runs generation for requests sent with "Prefer: respond-async"
+# Jobs run in this process after the response is sent, so async mode needs a long-lived worker;
+# a serverless function (api/index.py on Vercel) may be frozen or stopped mid-job
+_generation_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='story-generation')
+
+# Most Leonardo.ai calls one story keeps in flight at a time
+ILLUSTRATION_CONCURRENCY = 8
+
+# Story lists longer than this are streamed; shorter ones are built in full
+USER_STORIES_STREAM_THRESHOLD = 50
+
+# Serialized GET payloads: a story by (story ID, updated_at), a user's story list by user ID
+# next to the list's version. A story write in any process changes both versions, so stale
+# entries are never served, whichever worker made the write
+_story_cache = TTLCache(maxsize=1024, ttl=30)
+_user_stories_cache = TTLCache(maxsize=1024, ttl=30)
+
+def user_stories_version(user_id):
+    """The user's story count and latest updated_at, which change with any write to their stories"""
+    return tuple(db.session.execute(
+        db.select(func.count(Story.id), func.max(Story.updated_at))
+        .join(Child)
+        .where(Child.user_id == user_id)
+    ).one())
+
+def invalidate_user_stories_cache(user_id):
+    """Drop the user's cached story list early after a write in this process"""
+    _user_stories_cache.delete(user_id)
+
+@story_bp.errorhandler(Exception)
+def handle_story_error(e):
+    """Report errors from story routes as JSON, rolling back and answering 500 for unexpected ones"""
+    if isinstance(e, HTTPException):
+        return jsonify({'error': e.description}), e.code
+    db.session.rollback()
+    return jsonify({'error': str(e)}), 500
+
 @story_bp.route('/stories/create', methods=['POST'])
 def create_story():
-    try:
-        data = request.get_json()
-        
-        # Validate required fields
-        required_fields = ['user_id', 'child_name', 'child_age', 'birth_date', 'birth_month', 'story_idea']
-        for field in required_fields:
-            if not data or not data.get(field):
-                return jsonify({'error': f'{field} is required'}), 400
-        
-        user_id = data['user_id']
-        
-        # Verify user exists
-        user = User.query.get(user_id)
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-        
-        # Create or find child
-        child = Child.query.filter_by(
+    data = request.get_json()
+    
+    # Validate required fields
+    required_fields = ['user_id', 'child_name', 'child_age', 'birth_date', 'birth_month', 'story_idea']
+    for field in required_fields:
+        if not data or not str(data.get(field) or '').strip():
+            return jsonify({'error': f'{field} is required'}), 400
+    
+    user_id = int(data['user_id'])
+    # Stored trimmed; story word counts assume names and months without surrounding spaces
+    child_name = str(data['child_name']).strip()
+    birth_month = str(data['birth_month']).strip()
+    
+    # Verify user exists
+    if not db.session.scalar(db.select(db.exists().where(User.id == user_id))):
+        return jsonify({'error': 'User not found'}), 404
+    
+    # Create or find child
+    child = Child.query.filter_by(
+        user_id=user_id,
+        name=child_name
+    ).first()
+    
+    if not child:
+        # Create new child record
+        child = Child(
             user_id=user_id,
-            name=data['child_name']
-        ).first()
-        
-        if not child:
-            # Create new child record
-            child = Child(
-                user_id=user_id,
-                name=data['child_name'],
-                age=int(data['child_age']),
-                birth_date=datetime.strptime(data['birth_date'], '%Y-%m-%d').date(),
-                birth_month=data['birth_month'],
-                photo_1_url=data.get('photo_1_url', ''),
-                photo_2_url=data.get('photo_2_url', '')
-            )
-            db.session.add(child)
-            db.session.flush()  # Get the child ID
-        
-        # Create story
-        story = Story(
-            child_id=child.id,
-            original_idea=data['story_idea'],
-            status='draft'
+            name=child_name,
+            age=int(data['child_age']),
+            birth_date=datetime.strptime(data['birth_date'], '%Y-%m-%d').date(),
+            birth_month=birth_month,
+            photo_1_url=data.get('photo_1_url', ''),
+            photo_2_url=data.get('photo_2_url', '')
         )
-        db.session.add(story)
-        db.session.commit()
-        
-        return jsonify({
-            'message': 'Story creation initiated',
-            'story_id': story.id,
-            'child': child.to_dict(),
-            'story': story.to_dict()
-        }), 201
-        
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+        db.session.add(child)
+        db.session.flush()  # Get the child ID
+    
+    # Create story
+    story = Story(
+        child_id=child.id,
+        original_idea=data['story_idea'],
+        status='draft'
+    )
+    db.session.add(story)
+    db.session.commit()
+    invalidate_user_stories_cache(user_id)
+    
+    return jsonify({
+        'message': 'Story creation initiated',
+        'story_id': story.id,
+        'child': child.to_dict(),
+        'story': story.to_dict()
+    }), 201
+
+async def write_generated_story(story, status, variation='', previous_title=None):
+    """Generate the story's content with ChatGPT, store it with the given status and return the raw result"""
+    child = story.child
+    
+    # Use ChatGPT service to generate story
+    story_result = await chatgpt_service.generate_story(
+        child_name=child.name,
+        child_age=child.age,
+        birth_month=child.birth_month,
+        story_idea=story.original_idea,
+        variation=variation,
+        previous_title=previous_title
+    )
+    
+    # Update story with generated content
+    story.generated_title = story_result['title']
+    story.generated_summary = story_result['summary']
+    story.pages_content = story_result['pages']
+    story.status = status
+    
+    db.session.commit()
+    invalidate_user_stories_cache(child.user_id)
+    return story_result
+
+async def write_missing_illustrations(story):
+    """Generate Leonardo.ai illustrations for the story's pages that have none and return how many were added"""
+    story_id = story.id
+    
+    # Pages that still need an illustration, checked against one query
+    existing_pages = set(db.session.scalars(
+        db.select(Illustration.page_number).where(Illustration.story_id == story_id)
+    ))
+    # Repeated page numbers are generated once, since illustrations are unique per story page
+    pending_pages = []
+    for page in story.pages_content:
+        if page['page_number'] not in existing_pages:
+            existing_pages.add(page['page_number'])
+            pending_pages.append(page)
+    
+    # Use Leonardo.ai service to generate the missing pages concurrently, a bounded number at a time
+    semaphore = asyncio.Semaphore(ILLUSTRATION_CONCURRENCY)
+    
+    async def generate_page(page):
+        async with semaphore:
+            return await leonardo_service.generate_illustration(
+                prompt=page.get('illustration_prompt', f"Illustration for {page['title']}"),
+                child_name=story.child.name,
+                page_number=page['page_number'],
+                story_id=story_id
+            )
+    
+    illustration_results = await asyncio.gather(*[generate_page(page) for page in pending_pages])
+    
+    # Create illustration records with their Leonardo images in one multi-row INSERT
+    rows = [
+        {
+            'story_id': story_id,
+            'page_number': page['page_number'],
+            'chatgpt_image_url': f"/api/generated/chatgpt/story_{story_id}_page_{page['page_number']}.jpg",
+            'leonardo_images': [img['url'] for img in illustration_result['illustrations']],
+            'status': 'pending'
+        }
+        for page, illustration_result in zip(pending_pages, illustration_results)
+    ]
+    if rows:
+        db.session.execute(insert(Illustration), rows)
+    
+    db.session.commit()
+    return len(pending_pages)
+
+def prefers_async():
+    """Whether the client sent "Prefer: respond-async" to get 202 Accepted and poll instead of waiting"""
+    return 'respond-async' in request.headers.get('Prefer', '')
+
+def set_story_status(story_id, status):
+    """Store a new status for the story and commit"""
+    db.session.execute(update(Story).where(Story.id == story_id).values(status=status))
+    db.session.commit()
+
+def submit_generation(job, story_id, failed_status):
+    """Run the coroutine function job(story) for story_id on the background generation pool, storing failed_status if it raises"""
+    app = current_app._get_current_object()
+    
+    def run():
+        with app.app_context():
+            try:
+                story = db.session.get(Story, story_id, options=[joinedload(Story.child)])
+                asyncio.run(job(story))
+            except Exception:
+                db.session.rollback()
+                app.logger.exception('Background generation failed for story %s', story_id)
+                # Let pollers see that the job ended without a result
+                set_story_status(story_id, failed_status)
+    
+    _generation_executor.submit(run)
 
 @story_bp.route('/stories/<int:story_id>/generate', methods=['POST'])
-def generate_story_content(story_id):
+async def generate_story_content(story_id):
     """Generate story content using AI services"""
-    try:
-        story = Story.query.get(story_id)
-        if not story:
-            return jsonify({'error': 'Story not found'}), 404
-        
-        child = story.child
-        
-        # Use ChatGPT service to generate story
-        story_result = chatgpt_service.generate_story(
-            child_name=child.name,
-            child_age=child.age,
-            birth_month=child.birth_month,
-            story_idea=story.original_idea
-        )
-        
-        # Update story with generated content
-        story.generated_title = story_result['title']
-        story.generated_summary = story_result['summary']
-        story.set_pages_content(story_result['pages'])
-        story.status = 'generated'
-        story.updated_at = datetime.utcnow()
-        
-        db.session.commit()
-        
+    story = db.session.get(Story, story_id, options=[joinedload(Story.child)])
+    if not story:
+        return jsonify({'error': 'Story not found'}), 404
+    
+    # Clients that opt in poll the story while its status is 'generating',
+    # until it becomes 'generated' or 'generation_failed'
+    if prefers_async():
+        set_story_status(story_id, 'generating')
+        submit_generation(partial(write_generated_story, status='generated'), story_id, 'generation_failed')
         return jsonify({
-            'message': 'Story generated successfully using AI',
-            'story': story.to_dict(),
-            'generation_stats': {
-                'word_count': story_result['word_count'],
-                'generation_time': story_result['generation_time'],
-                'pages_generated': len(story_result['pages'])
-            }
-        }), 200
-        
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+            'message': 'Story generation queued',
+            'story_id': story_id,
+            'status': 'generating'
+        }), 202, {'Location': url_for('story.get_story', story_id=story_id)}
+    
+    story_result = await write_generated_story(story, 'generated')
+    
+    return jsonify({
+        'message': 'Story generated successfully using AI',
+        'story': story.to_dict(),
+        'generation_stats': {
+            'word_count': story_result['word_count'],
+            'generation_time': story_result['generation_time'],
+            'pages_generated': len(story_result['pages'])
+        }
+    }), 200
 
 @story_bp.route('/stories/<int:story_id>/generate-illustrations', methods=['POST'])
-def generate_story_illustrations(story_id):
+async def generate_story_illustrations(story_id):
     """Generate illustrations for story pages using Leonardo.ai simulation"""
-    try:
-        story = Story.query.get(story_id)
-        if not story:
-            return jsonify({'error': 'Story not found'}), 404
-        
-        child = story.child
-        pages_content = story.get_pages_content()
-        
-        if not pages_content:
-            return jsonify({'error': 'Story content not found'}), 400
-        
-        generated_count = 0
-        
-        # Generate illustrations for each page
-        for page in pages_content:
-            page_number = page['page_number']
-            illustration_prompt = page.get('illustration_prompt', f"Illustration for {page['title']}")
-            
-            # Check if illustration already exists
-            existing_illustration = Illustration.query.filter_by(
-                story_id=story_id,
-                page_number=page_number
-            ).first()
-            
-            if not existing_illustration:
-                # Use Leonardo.ai service to generate illustrations
-                illustration_result = leonardo_service.generate_illustration(
-                    prompt=illustration_prompt,
-                    child_name=child.name,
-                    page_number=page_number,
-                    story_id=story_id
-                )
-                
-                # Create illustration record
-                illustration = Illustration(
-                    story_id=story_id,
-                    page_number=page_number,
-                    chatgpt_image_url=f"/api/generated/chatgpt/story_{story_id}_page_{page_number}.jpg",
-                    status='pending'
-                )
-                
-                # Set Leonardo images
-                leonardo_urls = [img['url'] for img in illustration_result['illustrations']]
-                illustration.set_leonardo_images(leonardo_urls)
-                
-                db.session.add(illustration)
-                generated_count += 1
-        
-        db.session.commit()
-        
-        return jsonify({
-            'message': f'Generated {generated_count} illustrations using AI',
-            'story_id': story_id,
-            'generated_count': generated_count
-        }), 200
-        
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+    story = db.session.get(Story, story_id, options=[joinedload(Story.child)])
+    if not story:
+        return jsonify({'error': 'Story not found'}), 404
+    
+    if not story.pages_content:
+        return jsonify({'error': 'Story content not found'}), 400
+    
+    # Always answered synchronously: illustration jobs have no status a poller could wait on
+    generated_count = await write_missing_illustrations(story)
+    
+    return jsonify({
+        'message': f'Generated {generated_count} illustrations using AI',
+        'story_id': story_id,
+        'generated_count': generated_count
+    }), 200
 
 @story_bp.route('/stories/<int:story_id>', methods=['GET'])
 def get_story(story_id):
-    try:
-        story = Story.query.get(story_id)
+    # Check the story's current version with a single-column read before using the cache
+    version = db.session.execute(
+        db.select(Story.updated_at).where(Story.id == story_id)
+    ).first()
+    if version is None:
+        return jsonify({'error': 'Story not found'}), 404
+    
+    body = _story_cache.get((story_id, version.updated_at))
+    if body is None:
+        story = db.session.get(Story, story_id, options=[joinedload(Story.child)])
         if not story:
             return jsonify({'error': 'Story not found'}), 404
         
-        return jsonify({
+        body = fastjson.dumpb({
             'story': story.to_dict(),
             'child': story.child.to_dict()
-        }), 200
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+        })
+        _story_cache.set((story_id, story.updated_at), body)
+    
+    return current_app.response_class(body, mimetype='application/json')
 
 @story_bp.route('/stories/<int:story_id>/approve', methods=['PUT'])
 def approve_story(story_id):
-    try:
-        story = Story.query.get(story_id)
-        if not story:
-            return jsonify({'error': 'Story not found'}), 404
-        
-        story.status = 'approved'
-        story.updated_at = datetime.utcnow()
-        db.session.commit()
-        
-        return jsonify({
-            'message': 'Story approved successfully',
-            'story': story.to_dict()
-        }), 200
-        
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+    # Update and read back the story in one statement
+    story = db.session.scalars(
+        update(Story)
+        .where(Story.id == story_id)
+        .values(status='approved')
+        .returning(Story)
+        .execution_options(synchronize_session=False, populate_existing=True)
+    ).first()
+    if not story:
+        return jsonify({'error': 'Story not found'}), 404
+    
+    db.session.commit()
+    
+    return jsonify({
+        'message': 'Story approved successfully',
+        'story': story.to_dict()
+    }), 200
 
 @story_bp.route('/stories/<int:story_id>/regenerate', methods=['POST'])
-def regenerate_story(story_id):
-    try:
-        data = request.get_json()
-        story = Story.query.get(story_id)
-        if not story:
-            return jsonify({'error': 'Story not found'}), 404
-        
-        child = story.child
-        
-        # Update story idea if provided
-        if data and data.get('new_idea'):
-            story.original_idea = data['new_idea']
-        
-        # Regenerate story using AI service
-        story_result = chatgpt_service.generate_story(
-            child_name=child.name,
-            child_age=child.age,
-            birth_month=child.birth_month,
-            story_idea=story.original_idea
-        )
-        
-        # Update story with new content
-        story.generated_title = story_result['title']
-        story.generated_summary = story_result['summary']
-        story.set_pages_content(story_result['pages'])
-        story.status = 'regenerated'
-        story.updated_at = datetime.utcnow()
-        
-        db.session.commit()
-        
-        return jsonify({
-            'message': 'Story regenerated successfully using AI',
-            'story': story.to_dict(),
-            'generation_stats': {
-                'word_count': story_result['word_count'],
-                'generation_time': story_result['generation_time']
-            }
-        }), 200
-        
-    except Exception as e:
-        db.session.rollback()
-        return jsonify({'error': str(e)}), 500
+async def regenerate_story(story_id):
+    data = request.get_json()
+    story = db.session.get(Story, story_id, options=[joinedload(Story.child)])
+    if not story:
+        return jsonify({'error': 'Story not found'}), 404
+    
+    # Update story idea if provided
+    if data and data.get('new_idea'):
+        story.original_idea = data['new_idea']
+    
+    # Regenerate story using AI service; each attempt (story version) gets its own variation
+    # and never repeats the current title
+    story_result = await write_generated_story(
+        story, 'regenerated',
+        variation=f'{story.id}:{story.updated_at}',
+        previous_title=story.generated_title
+    )
+    
+    return jsonify({
+        'message': 'Story regenerated successfully using AI',
+        'story': story.to_dict(),
+        'generation_stats': {
+            'word_count': story_result['word_count'],
+            'generation_time': story_result['generation_time']
+        }
+    }), 200
 
 @story_bp.route('/user/<int:user_id>/stories', methods=['GET'])
 def get_user_stories(user_id):
-    try:
-        user = User.query.get(user_id)
-        if not user:
-            return jsonify({'error': 'User not found'}), 404
-        
-        # Get all stories for user's children
-        stories = db.session.query(Story).join(Child).filter(Child.user_id == user_id).all()
-        
-        return jsonify({
-            'stories': [story.to_dict() for story in stories]
-        }), 200
-        
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    # Serve the cached list only while it matches the database's current version
+    version = user_stories_version(user_id)
+    cached = _user_stories_cache.get(user_id)
+    if cached is not None and cached[0] == version:
+        return current_app.response_class(cached[1], mimetype='application/json')
+    
+    # A user with stories exists, so only an empty list needs the user check
+    if not version[0] and not db.session.scalar(db.select(db.exists().where(User.id == user_id))):
+        return jsonify({'error': 'User not found'}), 404
+    
+    # Get all stories for user's children, fetched from the cursor 50 rows at a time
+    stories = db.session.scalars(
+        db.select(Story)
+        .join(Child)
+        .where(Child.user_id == user_id)
+        .execution_options(yield_per=50)
+    )
+    
+    # Short lists are answered in one piece, so their errors still reach handle_story_error
+    first_stories = list(islice(stories, USER_STORIES_STREAM_THRESHOLD + 1))
+    if len(first_stories) <= USER_STORIES_STREAM_THRESHOLD:
+        body = fastjson.dumpb({'stories': [story.to_dict() for story in first_stories]})
+        _user_stories_cache.set(user_id, (version, body))
+        return current_app.response_class(body, mimetype='application/json')
+    
+    def generate():
+        # Stream {"stories": [...]} one story at a time, keeping the chunks for the cache
+        chunks = [b'{"stories":[']
+        yield chunks[0]
+        try:
+            for index, story in enumerate(chain(first_stories, stories)):
+                chunk = (b',' if index else b'') + fastjson.dumpb(story.to_dict())
+                chunks.append(chunk)
+                yield chunk
+        except Exception:
+            # The 200 is already sent; log and leave the body unterminated so clients see invalid JSON
+            current_app.logger.exception('Streaming stories for user %s failed', user_id)
+            return
+        chunks.append(b']}')
+        yield chunks[-1]
+        _user_stories_cache.set(user_id, (version, b''.join(chunks)))
+    
+    return current_app.response_class(stream_with_context(generate()), mimetype='application/json')
 
@@ -0,0 +1,79 @@
+"""
+In-process caching helpers for ZingyBooks
+Entries live in the current worker process only, so cache data that tolerates short staleness
+"""
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """Small thread-safe cache whose entries expire ttl seconds after they are set"""
+
+    def __init__(self, maxsize: int = 128, ttl: float = 30):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Return the cached value for key, or default if it is missing or expired"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return default
+            expires_at, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        """Store value under key, evicting the oldest entry when full"""
+        with self._lock:
+            now = time.monotonic()
+            self._data[key] = (now + self.ttl, value)
+            self._data.move_to_end(key)
+            self._drop_expired(now)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def incr(self, key: Hashable) -> Optional[int]:
+        """
+        Add one to the counter under key and return it; a new counter expires ttl seconds from now
+        Returns None instead of evicting a live entry when key is new and the cache is full
+        """
+        with self._lock:
+            now = time.monotonic()
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > now:
+                expires_at, count = entry
+                # Updated in place so entries stay in expiry order
+                self._data[key] = (expires_at, count + 1)
+                return count + 1
+            self._data.pop(key, None)
+            self._drop_expired(now)
+            if len(self._data) >= self.maxsize:
+                return None
+            self._data[key] = (now + self.ttl, 1)
+            return 1
+
+    def _drop_expired(self, now: float) -> None:
+        """Drop expired entries; every entry shares one ttl, so they sit in expiry order"""
+        while self._data:
+            expires_at, _ = next(iter(self._data.values()))
+            if expires_at > now:
+                break
+            self._data.popitem(last=False)
+
+    def delete(self, key: Hashable) -> None:
+        """Drop key from the cache if present"""
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self) -> None:
+        """Drop every entry"""
+        with self._lock:
+            self._data.clear()
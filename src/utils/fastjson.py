@@ -0,0 +1,67 @@
+"""
+Fast JSON helpers for ZingyBooks
+Uses orjson when it is installed and falls back to the standard library otherwise
+"""
+
+from datetime import date, datetime, timezone
+from typing import Any, Union
+
+from flask import current_app
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - exercised only without orjson
+    orjson = None
+    import json
+
+if orjson is not None:
+    # Naive datetimes in the models are UTC (datetime.utcnow)
+    _DUMPS_OPTIONS = orjson.OPT_NON_STR_KEYS | orjson.OPT_NAIVE_UTC
+
+    def dumpb(obj: Any) -> bytes:
+        """Serialize obj to UTF-8 JSON bytes"""
+        return orjson.dumps(obj, option=_DUMPS_OPTIONS)
+
+    def dumps(obj: Any) -> str:
+        """Serialize obj to a JSON string"""
+        return orjson.dumps(obj, option=_DUMPS_OPTIONS).decode()
+
+    loads = orjson.loads
+    JSONDecodeError = orjson.JSONDecodeError
+else:
+    def _default(obj: Any) -> Any:
+        """Match orjson's output for dates and naive UTC datetimes"""
+        if isinstance(obj, datetime):
+            if obj.tzinfo is None:
+                obj = obj.replace(tzinfo=timezone.utc)
+            return obj.isoformat()
+        if isinstance(obj, date):
+            return obj.isoformat()
+        raise TypeError(f'Object of type {type(obj).__name__} is not JSON serializable')
+
+    def dumps(obj: Any) -> str:
+        """Serialize obj to a JSON string"""
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), default=_default)
+
+    def dumpb(obj: Any) -> bytes:
+        """Serialize obj to UTF-8 JSON bytes"""
+        return dumps(obj).encode()
+
+    loads = json.loads
+    JSONDecodeError = json.JSONDecodeError
+
+
+class ORJSONProvider(DefaultJSONProvider):
+    """Flask JSON provider that routes jsonify() and request.get_json() through fastjson"""
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return dumps(obj)
+
+    def loads(self, s: Union[str, bytes], **kwargs: Any) -> Any:
+        return loads(s)
+
+
+def json_response(payload: Any, status: int = 200):
+    """Build a JSON response from payload without the str -> bytes round trip of jsonify()"""
+    return current_app.response_class(dumpb(payload), status=status, mimetype='application/json')
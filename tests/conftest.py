@@ -0,0 +1,42 @@
+import asyncio
+import os
+import sys
+import tempfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Build the app against a scratch SQLite file instead of src/database/app.db
+_db_dir = tempfile.mkdtemp(prefix='zingybooks-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_db_dir, 'test.db')}"
+
+from src.main import app as flask_app  # noqa: E402
+from src.models.user import db  # noqa: E402
+
+
+@pytest.fixture
+def app():
+    return flask_app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def session(app):
+    with app.app_context():
+        yield db.session
+
+
+@pytest.fixture
+def fast_ai(monkeypatch):
+    """Skip the simulated AI service latency"""
+    real_sleep = asyncio.sleep
+
+    async def no_wait(delay, *args, **kwargs):
+        await real_sleep(0)
+
+    monkeypatch.setattr(asyncio, 'sleep', no_wait)
@@ -0,0 +1,12 @@
+def test_dashboard_answers_if_none_match_with_304(client):
+    first = client.get('/api/admin/dashboard')
+    assert first.status_code == 200
+    etag = first.headers['ETag']
+
+    second = client.get('/api/admin/dashboard', headers={'If-None-Match': etag})
+    assert second.status_code == 304
+
+    # A different tag gets the full report again
+    third = client.get('/api/admin/dashboard', headers={'If-None-Match': '"stale"'})
+    assert third.status_code == 200
+    assert third.headers['ETag'] == etag
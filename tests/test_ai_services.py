@@ -0,0 +1,35 @@
+import asyncio
+
+import pytest
+
+from src.services.ai_services import ChatGPTService
+
+
+@pytest.mark.parametrize('child_name, child_age, birth_month', [
+    ('Zo', 5, 'May'),
+    ('Mary Ann', 7, 'May'),
+    ('Jean Luc Picard', 10, 'Late September'),
+])
+def test_word_count_matches_rendered_pages(fast_ai, child_name, child_age, birth_month):
+    story = asyncio.run(ChatGPTService().generate_story(child_name, child_age, birth_month, 'dragons'))
+
+    assert story['word_count'] == sum(len(page['content'].split()) for page in story['pages'])
+
+
+def test_regeneration_never_repeats_the_previous_title(fast_ai):
+    service = ChatGPTService()
+    first = asyncio.run(service.generate_story('Zo', 5, 'May', 'dragons'))
+
+    for attempt in range(10):
+        again = asyncio.run(service.generate_story('Zo', 5, 'May', 'dragons', variation=f'1:{attempt}',
+                                                   previous_title=first['title']))
+        assert again['title'] != first['title']
+        assert again['summary'] != first['summary']
+
+
+def test_same_inputs_and_variation_pick_the_same_theme(fast_ai):
+    service = ChatGPTService()
+    first = asyncio.run(service.generate_story('Zo', 5, 'May', 'dragons', variation='1:a'))
+    again = asyncio.run(service.generate_story('Zo', 5, 'May', 'dragons', variation='1:a'))
+
+    assert again['title'] == first['title']
@@ -0,0 +1,64 @@
+from werkzeug.security import generate_password_hash
+
+from src.models.user import User, OTP
+from src.routes import auth
+from src.utils.cache import TTLCache
+
+
+def test_login_rehashes_legacy_password_with_argon2(client, session):
+    session.add(User(email='legacy@example.com', name='Legacy',
+                     password_hash=generate_password_hash('secret', method='pbkdf2:sha256')))
+    session.commit()
+
+    response = client.post('/api/auth/login', json={'email': 'legacy@example.com', 'password': 'secret'})
+    assert response.status_code == 200
+
+    session.expire_all()
+    user = User.query.filter_by(email='legacy@example.com').one()
+    assert user.password_hash.startswith('$argon2id$')
+
+    # The upgraded hash still accepts the password and rejects others
+    assert client.post('/api/auth/login', json={'email': 'legacy@example.com', 'password': 'secret'}).status_code == 200
+    assert client.post('/api/auth/login', json={'email': 'legacy@example.com', 'password': 'wrong'}).status_code == 401
+
+
+def test_otp_can_be_used_once(client, session):
+    otp = client.post('/api/auth/send-otp', json={'email': 'otp@example.com'}).get_json()['otp']
+
+    first = client.post('/api/auth/verify-otp', json={'email': 'otp@example.com', 'otp': otp})
+    assert first.status_code == 200
+    assert first.get_json()['user']['email'] == 'otp@example.com'
+
+    second = client.post('/api/auth/verify-otp', json={'email': 'otp@example.com', 'otp': otp})
+    assert second.status_code == 400
+    assert OTP.query.filter_by(email='otp@example.com', otp_code=otp).one().is_used
+
+
+def test_google_auth_upserts_existing_user(client, session):
+    first = client.post('/api/auth/google', json={'email': 'G@Example.com', 'google_id': 'g-1', 'name': 'G'})
+    assert first.status_code == 200
+    user = first.get_json()['user']
+    assert user['created_at'] == user['last_login']
+
+    second = client.post('/api/auth/google', json={'email': 'g@example.com', 'google_id': 'g-2'})
+    assert second.status_code == 200
+    assert second.get_json()['user']['id'] == user['id']
+
+    rows = User.query.filter_by(email='g@example.com').all()
+    assert len(rows) == 1
+    # The first linked Google account is kept
+    assert rows[0].google_id == 'g-1'
+    assert rows[0].last_login > rows[0].created_at
+
+
+def test_send_otp_is_rate_limited_per_email(client, session, monkeypatch):
+    monkeypatch.setattr(auth, '_otp_send_counts', TTLCache(maxsize=2, ttl=60))
+
+    statuses = [client.post('/api/auth/send-otp', json={'email': 'limited@example.com'}).status_code
+                for _ in range(auth.OTP_SEND_LIMIT + 1)]
+    assert statuses == [200] * auth.OTP_SEND_LIMIT + [429]
+
+    # A flood of other addresses is refused too, and does not reset the limited one
+    assert client.post('/api/auth/send-otp', json={'email': 'other-1@example.com'}).status_code == 200
+    assert client.post('/api/auth/send-otp', json={'email': 'other-2@example.com'}).status_code == 429
+    assert client.post('/api/auth/send-otp', json={'email': 'limited@example.com'}).status_code == 429
@@ -0,0 +1,36 @@
+from src.utils import cache
+from src.utils.cache import TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_incr_counts_until_the_window_expires(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, 'monotonic', clock)
+    counts = TTLCache(maxsize=10, ttl=60)
+
+    assert [counts.incr('a') for _ in range(3)] == [1, 2, 3]
+    clock.now += 61
+    assert counts.incr('a') == 1
+
+
+def test_incr_refuses_new_keys_instead_of_evicting_live_counters(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache.time, 'monotonic', clock)
+    counts = TTLCache(maxsize=2, ttl=60)
+    counts.incr('target')
+    counts.incr('target')
+
+    counts.incr('flood-1')
+    assert counts.incr('flood-2') is None
+    assert counts.incr('target') == 3
+
+    # Once the old counters expire there is room again
+    clock.now += 61
+    assert counts.incr('flood-2') == 1
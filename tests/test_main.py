@@ -0,0 +1,30 @@
+import sqlite3
+
+from src.main import create_app
+
+
+def test_app_builds_on_in_memory_sqlite(monkeypatch):
+    monkeypatch.setenv('DATABASE_URL', 'sqlite://')
+
+    app = create_app()
+
+    assert 'pool_size' not in app.config['SQLALCHEMY_ENGINE_OPTIONS']
+    assert app.test_client().get('/api/health').status_code == 200
+
+
+def test_missing_unique_index_blocks_requests_until_created(monkeypatch, tmp_path):
+    db_path = tmp_path / 'old.db'
+    monkeypatch.setenv('DATABASE_URL', f'sqlite:///{db_path}')
+    create_app()
+    # A database created before the index was added to the models
+    with sqlite3.connect(db_path) as conn:
+        conn.execute('DROP INDEX ix_order_razorpay_order_id')
+
+    app = create_app()
+    response = app.test_client().get('/api/health')
+    assert response.status_code == 503
+
+    result = app.test_cli_runner().invoke(args=['create-indexes'])
+    assert result.exit_code == 0
+
+    assert create_app().test_client().get('/api/health').status_code == 200
@@ -0,0 +1,135 @@
+import hashlib
+import hmac
+from datetime import date
+
+import pytest
+
+from src.models.user import User, Child, Story, Order
+from src.routes import payment
+
+
+def sign(secret, message):
+    return hmac.new(secret.encode(), message, hashlib.sha256).hexdigest()
+
+
+@pytest.fixture
+def story(session):
+    user = User(email='buyer@example.com', name='Buyer')
+    session.add(user)
+    session.flush()
+    child = Child(user_id=user.id, name='Emma', age=5, birth_date=date(2019, 5, 1),
+                  birth_month='May', photo_1_url='', photo_2_url='')
+    session.add(child)
+    session.flush()
+    story = Story(child_id=child.id, original_idea='dragons', status='approved')
+    session.add(story)
+    session.commit()
+    yield story
+    Order.query.filter_by(story_id=story.id).delete()
+    session.delete(story)
+    session.delete(child)
+    session.delete(user)
+    session.commit()
+
+
+@pytest.fixture
+def order(session, story):
+    order = Order(user_id=story.child.user_id, story_id=story.id, book_title='Emma', purchase_option='pdf',
+                  price=497, razorpay_order_id='order_test_1')
+    session.add(order)
+    session.commit()
+    return order
+
+
+def verify(client, secret, order_id='order_test_1', payment_id='pay_1', signature=None):
+    if signature is None:
+        signature = sign(secret, f'{order_id}|{payment_id}'.encode())
+    return client.post('/api/payment/verify', json={
+        'razorpay_order_id': order_id,
+        'razorpay_payment_id': payment_id,
+        'razorpay_signature': signature
+    })
+
+
+def test_pricing_answers_if_none_match_with_304(client):
+    first = client.get('/api/payment/pricing')
+    assert first.status_code == 200
+    assert first.headers['ETag']
+
+    second = client.get('/api/payment/pricing', headers={'If-None-Match': first.headers['ETag']})
+    assert second.status_code == 304
+    assert second.data == b''
+
+
+def test_verify_rejects_bad_signature(client, order, monkeypatch):
+    monkeypatch.setattr(payment, 'RAZORPAY_KEY_SECRET', 'key-secret')
+
+    response = verify(client, 'wrong-secret')
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'Invalid payment signature'
+    assert Order.query.filter_by(razorpay_order_id='order_test_1').one().payment_status == 'pending'
+
+
+@pytest.mark.parametrize('signature', ['é' * 64, 123, ['abc']])
+def test_verify_rejects_malformed_signature(client, order, monkeypatch, signature):
+    monkeypatch.setattr(payment, 'RAZORPAY_KEY_SECRET', 'key-secret')
+
+    assert verify(client, 'key-secret', signature=signature).status_code == 400
+
+
+def test_verify_accepts_good_signature(client, order, monkeypatch):
+    monkeypatch.setattr(payment, 'RAZORPAY_KEY_SECRET', 'key-secret')
+
+    response = verify(client, 'key-secret')
+    assert response.status_code == 200
+    assert response.get_json()['order']['payment_status'] == 'completed'
+
+
+def test_verify_without_secret_fails_closed(client, order, monkeypatch):
+    monkeypatch.setattr(payment, 'RAZORPAY_KEY_SECRET', None)
+    monkeypatch.setattr(payment, 'RAZORPAY_DEMO_MODE', False)
+    assert verify(client, 'any', signature='sig').status_code == 400
+
+    monkeypatch.setattr(payment, 'RAZORPAY_DEMO_MODE', True)
+    assert verify(client, 'any', signature='sig').status_code == 200
+
+
+def test_webhook_rejects_bad_signature(client, monkeypatch):
+    monkeypatch.setattr(payment, 'RAZORPAY_WEBHOOK_SECRET', 'hook-secret')
+    body = b'{"event": "payment.failed", "payload": {}}'
+
+    def post(headers):
+        return client.post('/api/payment/webhook', data=body, content_type='application/json', headers=headers)
+
+    assert post({'X-Razorpay-Signature': sign('wrong-secret', body)}).status_code == 400
+    assert post({'X-Razorpay-Signature': 'é'}).status_code == 400
+    assert post({}).status_code == 400
+    assert post({'X-Razorpay-Signature': sign('hook-secret', body)}).status_code == 200
+
+
+def test_verify_completes_pdf_orders_with_a_download_link(client, order, monkeypatch):
+    monkeypatch.setattr(payment, 'RAZORPAY_KEY_SECRET', 'key-secret')
+
+    verified = verify(client, 'key-secret').get_json()['order']
+    assert verified['payment_status'] == 'completed'
+    assert verified['order_status'] == 'completed'
+    assert verified['razorpay_payment_id'] == 'pay_1'
+    assert verified['pdf_file_url'] == f"/api/generated/pdf/order_{order.id}_book.pdf"
+
+
+def test_verify_confirms_printed_orders_without_a_download_link(client, session, story, monkeypatch):
+    monkeypatch.setattr(payment, 'RAZORPAY_KEY_SECRET', 'key-secret')
+    session.add(Order(user_id=story.child.user_id, story_id=story.id, book_title='Emma', purchase_option='hard',
+                      price=1897, razorpay_order_id='order_test_hard'))
+    session.commit()
+
+    verified = verify(client, 'key-secret', order_id='order_test_hard').get_json()['order']
+    assert verified['payment_status'] == 'completed'
+    assert verified['order_status'] == 'payment_confirmed'
+    assert verified['pdf_file_url'] is None
+
+
+def test_verify_unknown_order_is_404(client, monkeypatch):
+    monkeypatch.setattr(payment, 'RAZORPAY_KEY_SECRET', 'key-secret')
+
+    assert verify(client, 'key-secret', order_id='order_missing').status_code == 404
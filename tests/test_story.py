@@ -0,0 +1,191 @@
+import json
+import time
+from uuid import uuid4
+
+import pytest
+from sqlalchemy import update
+
+from src.models.user import Story
+from src.routes import story as story_routes
+from src.services.ai_services import chatgpt_service
+
+
+@pytest.fixture
+def user_id(client):
+    response = client.post('/api/auth/register', json={'email': f'parent-{uuid4().hex}@example.com', 'name': 'Parent'})
+    return response.get_json()['user']['id']
+
+
+def create_story(client, user_id, **fields):
+    payload = {'user_id': user_id, 'child_name': 'Emma', 'child_age': 5, 'birth_date': '2019-05-01',
+               'birth_month': 'May', 'story_idea': 'dragons'}
+    payload.update(fields)
+    return client.post('/api/stories/create', json=payload)
+
+
+def test_create_story_trims_names_so_word_counts_match(client, user_id, fast_ai):
+    created = create_story(client, user_id, child_name='  Zo  ', birth_month=' May ')
+    assert created.status_code == 201
+    assert created.get_json()['child']['name'] == 'Zo'
+
+    generated = client.post(f"/api/stories/{created.get_json()['story_id']}/generate").get_json()
+    pages = generated['story']['pages_content']
+    assert generated['generation_stats']['word_count'] == sum(len(page['content'].split()) for page in pages)
+
+
+def test_create_story_rejects_blank_child_name(client, user_id):
+    response = create_story(client, user_id, child_name='   ')
+    assert response.status_code == 400
+    assert response.get_json() == {'error': 'child_name is required'}
+
+
+def write_from_another_worker(session, statement):
+    """Change stories behind this process's caches, as a different worker would"""
+    # SQLite stamps updated_at to the millisecond; keep the write in a later one
+    time.sleep(0.002)
+    session.execute(statement)
+    session.commit()
+
+
+def test_story_cache_sees_writes_from_other_workers(client, session, user_id):
+    story_id = create_story(client, user_id).get_json()['story_id']
+    assert client.get(f'/api/stories/{story_id}').get_json()['story']['status'] == 'draft'
+
+    write_from_another_worker(session, update(Story).where(Story.id == story_id).values(status='approved'))
+
+    assert client.get(f'/api/stories/{story_id}').get_json()['story']['status'] == 'approved'
+
+
+def test_user_story_list_sees_writes_from_other_workers(client, session, user_id):
+    story_id = create_story(client, user_id).get_json()['story_id']
+    assert len(client.get(f'/api/user/{user_id}/stories').get_json()['stories']) == 1
+
+    write_from_another_worker(session, update(Story).where(Story.id == story_id).values(status='approved'))
+    stories = client.get(f'/api/user/{user_id}/stories').get_json()['stories']
+    assert [story['status'] for story in stories] == ['approved']
+
+    child_id = stories[0]['child_id']
+    session.add(Story(child_id=child_id, original_idea='pirates', status='draft'))
+    session.commit()
+    assert len(client.get(f'/api/user/{user_id}/stories').get_json()['stories']) == 2
+
+
+def test_user_story_list_reflects_route_writes(client, user_id):
+    story_id = create_story(client, user_id).get_json()['story_id']
+    assert client.get(f'/api/user/{user_id}/stories').get_json()['stories'][0]['status'] == 'draft'
+
+    time.sleep(0.002)
+    assert client.put(f'/api/stories/{story_id}/approve').status_code == 200
+    assert client.get(f'/api/user/{user_id}/stories').get_json()['stories'][0]['status'] == 'approved'
+
+
+def test_user_story_list_for_unknown_user_is_404(client):
+    assert client.get('/api/user/999999/stories').status_code == 404
+
+
+def add_stories(client, session, user_id, count):
+    child_id = create_story(client, user_id).get_json()['child']['id']
+    session.add_all(Story(child_id=child_id, original_idea=f'idea {n}', status='draft') for n in range(count - 1))
+    session.commit()
+
+
+def test_short_story_list_is_sent_whole(client, session, user_id):
+    add_stories(client, session, user_id, story_routes.USER_STORIES_STREAM_THRESHOLD)
+
+    response = client.get(f'/api/user/{user_id}/stories')
+    assert response.headers.get('Content-Length')
+    assert len(response.get_json()['stories']) == story_routes.USER_STORIES_STREAM_THRESHOLD
+
+
+def test_long_story_list_is_streamed_and_cached(client, session, user_id):
+    count = story_routes.USER_STORIES_STREAM_THRESHOLD + 20
+    add_stories(client, session, user_id, count)
+
+    response = client.get(f'/api/user/{user_id}/stories')
+    assert 'Content-Length' not in response.headers
+    streamed = json.loads(response.data)
+    assert len(streamed['stories']) == count
+    assert len({story['id'] for story in streamed['stories']}) == count
+
+    # The joined chunks went into the cache and are served again as one body
+    cached = client.get(f'/api/user/{user_id}/stories')
+    assert cached.headers.get('Content-Length')
+    assert json.loads(cached.data) == streamed
+
+
+def test_failed_stream_is_logged_and_not_cached(client, session, user_id, monkeypatch, caplog):
+    add_stories(client, session, user_id, story_routes.USER_STORIES_STREAM_THRESHOLD + 5)
+    to_dict = Story.to_dict
+    calls = []
+
+    def failing_to_dict(story):
+        calls.append(story.id)
+        if len(calls) > story_routes.USER_STORIES_STREAM_THRESHOLD + 2:
+            raise ValueError('bad row')
+        return to_dict(story)
+
+    monkeypatch.setattr(Story, 'to_dict', failing_to_dict)
+    response = client.get(f'/api/user/{user_id}/stories')
+
+    assert response.status_code == 200
+    with pytest.raises(ValueError):
+        json.loads(response.data)
+    assert 'Streaming stories for user' in caplog.text
+    assert story_routes._user_stories_cache.get(user_id) is None
+
+
+def wait_for_status(client, story_id, pending='generating', timeout=5):
+    """Poll the story as an async client would until it leaves the pending status"""
+    deadline = time.monotonic() + timeout
+    while True:
+        status = client.get(f'/api/stories/{story_id}').get_json()['story']['status']
+        if status != pending or time.monotonic() > deadline:
+            return status
+        time.sleep(0.01)
+
+
+def test_async_generation_reports_generating_then_generated(client, user_id, fast_ai):
+    story_id = create_story(client, user_id).get_json()['story_id']
+
+    response = client.post(f'/api/stories/{story_id}/generate', headers={'Prefer': 'respond-async'})
+    assert response.status_code == 202
+    assert response.get_json()['status'] == 'generating'
+    assert response.headers['Location'].endswith(f'/api/stories/{story_id}')
+
+    assert wait_for_status(client, story_id) == 'generated'
+    assert client.get(f'/api/stories/{story_id}').get_json()['story']['pages_content']
+
+
+def test_async_generation_failure_is_recorded(client, user_id, monkeypatch):
+    async def unavailable(**kwargs):
+        raise RuntimeError('ChatGPT is unavailable')
+
+    monkeypatch.setattr(chatgpt_service, 'generate_story', unavailable)
+    story_id = create_story(client, user_id).get_json()['story_id']
+
+    response = client.post(f'/api/stories/{story_id}/generate', headers={'Prefer': 'respond-async'})
+    assert response.status_code == 202
+    assert wait_for_status(client, story_id) == 'generation_failed'
+
+
+def test_illustrations_are_generated_synchronously_even_when_async_is_preferred(client, user_id, fast_ai):
+    story_id = create_story(client, user_id).get_json()['story_id']
+    client.post(f'/api/stories/{story_id}/generate')
+
+    response = client.post(f'/api/stories/{story_id}/generate-illustrations', headers={'Prefer': 'respond-async'})
+    assert response.status_code == 200
+    assert response.get_json()['generated_count'] == len(
+        client.get(f'/api/illustrations/story/{story_id}').get_json()['illustrations'])
+
+
+def test_regenerate_without_a_new_idea_changes_the_story(client, user_id, fast_ai):
+    story_id = create_story(client, user_id).get_json()['story_id']
+    titles = [client.post(f'/api/stories/{story_id}/generate').get_json()['story']['generated_title']]
+
+    for _ in range(3):
+        response = client.post(f'/api/stories/{story_id}/regenerate', json={})
+        assert response.status_code == 200
+        story = response.get_json()['story']
+        assert story['status'] == 'regenerated'
+        assert story['generated_title'] != titles[-1]
+        titles.append(story['generated_title'])